@@ -15,19 +15,22 @@ import os
 import json
 import math
 import requests
+import threading
 
 from config import Config
-from app.models import db, User, DailyMetric, Activity, SyncLog, ChatMessage, UserMemory, FatigueLog, WeeklyCheck, FoodEntry, GymProfile, WorkoutProgram, WorkoutDay, ProgramExercise, ExerciseLog, WorkoutSession, GymWeeklyReport
+from app.models import db, get_fernet, User, DailyMetric, Activity, SyncLog, ChatMessage, UserMemory, FatigueLog, WeeklyCheck, FoodEntry, GymProfile, WorkoutProgram, WorkoutDay, ProgramExercise, ExerciseLog, WorkoutSession, GymWeeklyReport
 from app.exercises import EXERCISES, get_exercises_for_ui, get_exercise_by_id, select_exercises_for_day, get_exercises_for_muscle
-from app.garmin_sync import GarminSyncService
+from app.garmin_sync import GarminSyncService, recompute_biological_age
 
 
-def create_app():
+def create_app(config_class=Config):
     app = Flask(__name__, static_folder='../static', static_url_path='')
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
     
     # Init extensions
     db.init_app(app)
+    # Chiave di cifratura derivata una sola volta per processo
+    app.extensions['fernet'] = get_fernet(app.config['ENCRYPTION_KEY'])
     CORS(app)
     
     # Create tables
@@ -62,6 +65,69 @@ def create_app():
                 "ALTER TABLE exercise_logs ADD COLUMN IF NOT EXISTS target_reps INTEGER",
                 "ALTER TABLE exercise_logs ADD COLUMN IF NOT EXISTS target_rpe INTEGER",
                 "ALTER TABLE exercise_logs ADD COLUMN IF NOT EXISTS completed_target BOOLEAN DEFAULT FALSE",
+                # Colonne JSON salvate come TEXT -> JSONB (solo Postgres, una volta sola).
+                # I valori legacy malformati (che i vecchi getter ignoravano) diventano il
+                # valore vuoto invece di far fallire il cast dell'intera colonna
+                """CREATE OR REPLACE FUNCTION try_jsonb(value TEXT) RETURNS JSONB AS $$
+                BEGIN
+                    RETURN NULLIF(value, '')::jsonb;
+                EXCEPTION WHEN others THEN
+                    RETURN NULL;
+                END $$ LANGUAGE plpgsql IMMUTABLE""",
+                *[
+                    f"""DO $$ BEGIN
+                        IF (SELECT data_type FROM information_schema.columns
+                            WHERE table_name = '{table}' AND column_name = '{column}') = 'text' THEN
+                            ALTER TABLE {table} ALTER COLUMN {column} DROP DEFAULT;
+                            ALTER TABLE {table} ALTER COLUMN {column} TYPE JSONB
+                                USING COALESCE(try_jsonb({column}), '{empty}'::jsonb);
+                        END IF;
+                    END $$"""
+                    for table, column, empty in (
+                        ('weekly_checks', 'answers', '{}'),
+                        ('gym_profiles', 'excluded_muscles', '[]'),
+                        ('gym_profiles', 'priority_muscles', '[]'),
+                        ('gym_profiles', 'equipment', '[]'),
+                        ('gym_profiles', 'favorite_exercises', '[]'),
+                        ('gym_profiles', 'custom_exercises', '[]'),
+                        ('workout_days', 'muscle_groups', '[]'),
+                        ('exercise_logs', 'reps_per_set', '[]'),
+                        ('gym_weekly_reports', 'prs_achieved', '[]'),
+                        ('gym_weekly_reports', 'muscle_progress', '{}'),
+                    )
+                ],
+                # ChatMessage.role VARCHAR -> enum chat_role (solo Postgres, una volta sola)
+                """DO $$ BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'chat_role') THEN
+                        CREATE TYPE chat_role AS ENUM ('user', 'assistant');
+                    END IF;
+                    IF (SELECT data_type FROM information_schema.columns
+                        WHERE table_name = 'chat_messages' AND column_name = 'role') = 'character varying' THEN
+                        ALTER TABLE chat_messages ALTER COLUMN role TYPE chat_role USING role::chat_role;
+                    END IF;
+                END $$""",
+                # Blob raw: già gzip -> niente pglz inutile
+                "ALTER TABLE daily_metric_raw ALTER COLUMN raw_json_gz SET STORAGE EXTERNAL",
+                # Timestamp riempiti dal database (server_default now())
+                *[
+                    f"ALTER TABLE {table.name} ALTER COLUMN {column.name} SET DEFAULT now()"
+                    for table in db.metadata.sorted_tables
+                    for column in table.columns
+                    if column.name in ('created_at', 'updated_at', 'started_at') and column.server_default is not None
+                ],
+                # Indici
+                "CREATE INDEX IF NOT EXISTS ix_user_date_cover ON daily_metrics (user_id, date) INCLUDE (id)",
+                "CREATE INDEX IF NOT EXISTS ix_activities_user_start ON activities (user_id, start_time DESC)",
+                "CREATE INDEX IF NOT EXISTS ix_chat_messages_user_coach_created ON chat_messages (user_id, coach, created_at DESC)",
+                "CREATE INDEX IF NOT EXISTS ix_food_entries_user_date_meal ON food_entries (user_id, date, meal_type)",
+                "CREATE INDEX IF NOT EXISTS ix_exercise_logs_user_date ON exercise_logs (user_id, date DESC)",
+                "CREATE INDEX IF NOT EXISTS ix_workout_sessions_user_date ON workout_sessions (user_id, date DESC)",
+                "CREATE INDEX IF NOT EXISTS ix_gym_weekly_reports_user_week ON gym_weekly_reports (user_id, week_start DESC)",
+                # Indici parziali sui flag booleani
+                "CREATE INDEX IF NOT EXISTS ix_users_sync_enabled ON users (id) WHERE sync_enabled = true",
+                "CREATE INDEX IF NOT EXISTS ix_user_memories_user_active ON user_memories (user_id) WHERE is_active = true",
+                "CREATE INDEX IF NOT EXISTS ix_workout_programs_user_active ON workout_programs (user_id) WHERE is_active = true",
+                "CREATE INDEX IF NOT EXISTS ix_exercise_logs_user_pr ON exercise_logs (user_id, date DESC) WHERE is_pr = true",
             ]
             for sql in migrations:
                 try:
@@ -117,7 +183,7 @@ def create_app():
         # Se fornite, salva anche credenziali Garmin
         if data.get('garmin_email') and data.get('garmin_password'):
             user.garmin_email = data['garmin_email']
-            user.set_garmin_password(data['garmin_password'], app.config['ENCRYPTION_KEY'])
+            user.set_garmin_password(data['garmin_password'])
         
         db.session.add(user)
         db.session.commit()
@@ -185,7 +251,7 @@ def create_app():
         
         # Salva credenziali
         current_user.garmin_email = data['garmin_email']
-        current_user.set_garmin_password(data['garmin_password'], app.config['ENCRYPTION_KEY'])
+        current_user.set_garmin_password(data['garmin_password'])
         db.session.commit()
         
         return jsonify({'message': 'Account Garmin collegato'})
@@ -212,11 +278,65 @@ def create_app():
         days_back = data.get('days_back', 7)
         offset_days = data.get('offset_days', 0)  # Per sync a blocchi
         
-        service = GarminSyncService(app.config['ENCRYPTION_KEY'])
+        # Sync lunghi (es. backfill): gira in background, il client fa polling
+        if data.get('background'):
+            log = SyncLog(user_id=current_user.id, status='queued')
+            db.session.add(log)
+            db.session.commit()
+            threading.Thread(
+                target=_run_background_sync,
+                args=(current_user.id, log.id, days_back, offset_days),
+                daemon=True
+            ).start()
+            return jsonify({'sync_log_id': log.id, 'status': log.status}), 202
+        
+        service = GarminSyncService()
         result = service.sync_user(current_user, days_back=days_back, offset_days=offset_days)
         
         return jsonify(result)
     
+    def _run_background_sync(user_id, log_id, days_back, offset_days):
+        """Esegue sync_user fuori dalla request, con il suo app context"""
+        with app.app_context():
+            try:
+                user = User.query.get(user_id)
+                log = SyncLog.query.get(log_id)
+                service = GarminSyncService()
+                service.sync_user(user, days_back=days_back, offset_days=offset_days, log=log)
+            except Exception as e:
+                print(f"[Sync] Background sync utente {user_id} fallito: {e}")
+                # Il log non deve restare 'queued' per sempre
+                try:
+                    db.session.rollback()
+                    log = SyncLog.query.get(log_id)
+                    if log and log.status in ('queued', 'running'):
+                        log.status = 'error'
+                        log.error_message = str(e)
+                        log.finished_at = datetime.utcnow()
+                        db.session.commit()
+                except Exception as log_error:
+                    print(f"[Sync] Impossibile aggiornare il log {log_id}: {log_error}")
+            finally:
+                db.session.remove()
+    
+    @app.route('/api/sync/status/<int:log_id>', methods=['GET'])
+    @token_required
+    def sync_status(current_user, log_id):
+        """Stato di un sync (anche in background)"""
+        log = SyncLog.query.filter_by(id=log_id, user_id=current_user.id).first()
+        if not log:
+            return jsonify({'error': 'Sync non trovato'}), 404
+        
+        return jsonify({
+            'sync_log_id': log.id,
+            'status': log.status,
+            'metrics_synced': log.metrics_synced,
+            'activities_synced': log.activities_synced,
+            'error': log.error_message,
+            'started_at': log.started_at.isoformat() if log.started_at else None,
+            'finished_at': log.finished_at.isoformat() if log.finished_at else None
+        })
+    
     # ========== METRICS ==========
     
     @app.route('/api/metrics/today', methods=['GET'])
@@ -355,9 +475,7 @@ def create_app():
         
         try:
             # Decrypt e connetti
-            from cryptography.fernet import Fernet
-            fernet = Fernet(app.config['ENCRYPTION_KEY'])
-            password = fernet.decrypt(current_user.garmin_password_encrypted.encode()).decode()
+            password = current_user.get_garmin_password()
             
             client = Garmin(current_user.garmin_email, password)
             client.login()
@@ -421,9 +539,7 @@ def create_app():
             return jsonify({'error': 'Garmin non connesso'}), 400
         
         try:
-            from cryptography.fernet import Fernet
-            fernet = Fernet(app.config['ENCRYPTION_KEY'])
-            password = fernet.decrypt(current_user.garmin_password_encrypted.encode()).decode()
+            password = current_user.get_garmin_password()
             
             client = Garmin(current_user.garmin_email, password)
             client.login()
@@ -1581,7 +1697,7 @@ MEDITAZIONI: Segui le istruzioni sopra per la durata richiesta (ignora limite pa
         age = user.get_real_age()
         
         # Get gym profile
-        profile = GymProfile.query.filter_by(user_id=user.id).first()
+        profile = user.gym_profile
         
         # Get recent workout data
         recent_sessions = WorkoutSession.query.filter_by(user_id=user.id).order_by(WorkoutSession.date.desc()).limit(5).all()
@@ -1924,7 +2040,7 @@ Max 200 parole. Sii pratica e motivante! Usa i dati di progressione per dare con
             ).order_by(WeeklyCheck.created_at.desc()).first()
             
             if check:
-                answers = json.loads(check.answers)
+                answers = check.get_answers_dict()
                 days_ago = (datetime.utcnow() - check.created_at).days if check.created_at else 999
                 
                 wellness[f'{coach}_checkin'] = {
@@ -2387,9 +2503,9 @@ Max 200 parole. Sii pratica e motivante! Usa i dati di progressione per dare con
                 history = ChatMessage.query.filter(
                     ChatMessage.user_id == current_user.id,
                     or_(ChatMessage.coach == 'sensei', ChatMessage.coach == None)
-                ).order_by(ChatMessage.created_at.desc()).limit(10).all()
+                ).order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(10).all()
             else:
-                history = ChatMessage.query.filter_by(user_id=current_user.id, coach=coach).order_by(ChatMessage.created_at.desc()).limit(10).all()
+                history = ChatMessage.query.filter_by(user_id=current_user.id, coach=coach).order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(10).all()
             history.reverse()
         except Exception as e:
             history = []
@@ -2419,10 +2535,12 @@ Max 200 parole. Sii pratica e motivante! Usa i dati di progressione per dare con
             resp = openai_client.chat.completions.create(model="gpt-4.1", messages=messages, max_tokens=max_tokens, temperature=0.8)
             ai_raw = resp.choices[0].message.content
             
-            # Save messages
-            db.session.add(ChatMessage(user_id=current_user.id, role='user', content=msg, coach=coach))
+            # Save messages (un solo INSERT multi-riga)
             ai_clean = _extract_memories(ai_raw, current_user.id, coach)
-            db.session.add(ChatMessage(user_id=current_user.id, role='assistant', content=ai_clean, coach=coach))
+            db.session.execute(db.insert(ChatMessage), [
+                {'user_id': current_user.id, 'role': 'user', 'content': msg, 'coach': coach},
+                {'user_id': current_user.id, 'role': 'assistant', 'content': ai_clean, 'coach': coach},
+            ])
             db.session.commit()
             
             return jsonify({'response': ai_clean, 'coach': coach})
@@ -2441,9 +2559,9 @@ Max 200 parole. Sii pratica e motivante! Usa i dati di progressione per dare con
             msgs = ChatMessage.query.filter(
                 ChatMessage.user_id == current_user.id,
                 or_(ChatMessage.coach == 'sensei', ChatMessage.coach == None)
-            ).order_by(ChatMessage.created_at.desc()).limit(limit).all()
+            ).order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit).all()
         else:
-            msgs = ChatMessage.query.filter_by(user_id=current_user.id, coach=coach).order_by(ChatMessage.created_at.desc()).limit(limit).all()
+            msgs = ChatMessage.query.filter_by(user_id=current_user.id, coach=coach).order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit).all()
         
         msgs.reverse()
         return jsonify([{'role': m.role, 'content': m.content} for m in msgs])
@@ -2679,88 +2797,8 @@ Sii specifico, cita numeri esatti, evita generalita. Parla come uno scienziato e
         except Exception as e:
             db.session.rollback()
         
-        metrics = DailyMetric.query.filter_by(user_id=current_user.id).all()
-        count = 0
         real_age = current_user.get_real_age()
-        MAX_YEARS = 8  # Range finale ±8 anni
-        
-        for metric in metrics:
-            # Calcola impatti normalizzati (-1 a +1)
-            impacts = {}
-            
-            # 1. RHR (baseline 60, range 40-80)
-            if metric.resting_hr and metric.resting_hr > 0:
-                rhr = metric.resting_hr
-                raw = (rhr - 60) / 20
-                impacts['rhr'] = max(-1, min(1, raw))
-            
-            # 2. VO2 Max (baseline 42, range 30-55)
-            if metric.vo2_max and metric.vo2_max > 0:
-                vo2 = metric.vo2_max
-                raw = (42 - vo2) / 13
-                impacts['vo2'] = max(-1, min(1, raw))
-            
-            # 3. Sleep (ottimale 7-8.5h)
-            if metric.sleep_seconds and metric.sleep_seconds > 0:
-                sleep_hours = metric.sleep_seconds / 3600
-                if sleep_hours >= 7 and sleep_hours <= 8.5:
-                    impacts['sleep'] = -0.3
-                elif sleep_hours < 7:
-                    impacts['sleep'] = min(1, (7 - sleep_hours) / 3)
-                else:
-                    impacts['sleep'] = min(0.5, (sleep_hours - 8.5) / 3)
-            
-            # 4. Steps
-            if metric.steps and metric.steps > 0:
-                steps = metric.steps
-                if steps >= 12000: impacts['steps'] = -0.8
-                elif steps >= 10000: impacts['steps'] = -0.5
-                elif steps >= 8000: impacts['steps'] = -0.2
-                elif steps >= 6000: impacts['steps'] = 0.0
-                elif steps >= 4000: impacts['steps'] = 0.3
-                elif steps >= 2000: impacts['steps'] = 0.6
-                else: impacts['steps'] = 1.0
-            
-            # 5. Intensity Minutes
-            moderate = metric.moderate_intensity_minutes or 0
-            vigorous = metric.vigorous_intensity_minutes or 0
-            intensity_score = moderate + (vigorous * 2)
-            
-            if intensity_score > 0 or (metric.steps and metric.steps > 0):
-                if intensity_score >= 60: impacts['hrz'] = -0.8
-                elif intensity_score >= 45: impacts['hrz'] = -0.5
-                elif intensity_score >= 30: impacts['hrz'] = -0.2
-                elif intensity_score >= 15: impacts['hrz'] = 0.0
-                elif intensity_score >= 5: impacts['hrz'] = 0.3
-                else: impacts['hrz'] = 0.5
-            
-            # Minimo 2 metriche
-            if len(impacts) < 2:
-                metric.biological_age = None
-                metric.bio_age_rhr_impact = None
-                metric.bio_age_vo2_impact = None
-                metric.bio_age_sleep_impact = None
-                metric.bio_age_steps_impact = None
-                metric.bio_age_hrz_impact = None
-                metric.bio_age_stress_impact = None
-                continue
-            
-            # Media normalizzata
-            avg_impact = sum(impacts.values()) / len(impacts)
-            final_impact = avg_impact * MAX_YEARS
-            
-            # Salva impatti scalati per display
-            scale = MAX_YEARS / len(impacts)
-            metric.bio_age_rhr_impact = round(impacts.get('rhr', 0) * scale, 1) if 'rhr' in impacts else None
-            metric.bio_age_vo2_impact = round(impacts.get('vo2', 0) * scale, 1) if 'vo2' in impacts else None
-            metric.bio_age_sleep_impact = round(impacts.get('sleep', 0) * scale, 1) if 'sleep' in impacts else None
-            metric.bio_age_steps_impact = round(impacts.get('steps', 0) * scale, 1) if 'steps' in impacts else None
-            metric.bio_age_hrz_impact = round(impacts.get('hrz', 0) * scale, 1) if 'hrz' in impacts else None
-            metric.bio_age_stress_impact = None
-            
-            metric.biological_age = round(real_age + final_impact, 1)
-            count += 1
-        
+        count = recompute_biological_age(current_user.id, real_age)
         db.session.commit()
         return jsonify({'message': f'Ricalcolati {count} giorni (formula normalizzata v2)', 'count': count, 'real_age': real_age})
     
@@ -2792,8 +2830,6 @@ Sii specifico, cita numeri esatti, evita generalita. Parla come uno scienziato e
     @token_required
     def debug_hrv(current_user):
         """Debug: verifica TUTTI i dati disponibili da Garmin"""
-        import os
-        
         try:
             from garminconnect import Garmin
         except ImportError as e:
@@ -2802,15 +2838,11 @@ Sii specifico, cita numeri esatti, evita generalita. Parla come uno scienziato e
         if not current_user.garmin_email:
             return jsonify({'error': 'Garmin non connesso'}), 400
         
-        encryption_key = os.environ.get('ENCRYPTION_KEY')
-        if not encryption_key:
-            return jsonify({'error': 'ENCRYPTION_KEY non configurata'}), 500
-            
         if not current_user.garmin_password_encrypted:
             return jsonify({'error': 'Password Garmin non salvata'}), 400
         
         try:
-            garmin_password = current_user.get_garmin_password(encryption_key)
+            garmin_password = current_user.get_garmin_password()
         except Exception as e:
             return jsonify({'error': f'Decrypt password fallito: {str(e)}'}), 500
         
@@ -3099,7 +3131,7 @@ Pauses: Use thoughtful pauses, especially between sentences, enhancing relaxatio
         check = WeeklyCheck(
             user_id=current_user.id,
             coach=coach,
-            answers=json.dumps(answers)
+            answers=answers
         )
         db.session.add(check)
         db.session.commit()
@@ -3123,7 +3155,7 @@ Pauses: Use thoughtful pauses, especially between sentences, enhancing relaxatio
         if check:
             return jsonify({
                 'coach': coach,
-                'answers': json.loads(check.answers),
+                'answers': check.get_answers_dict(),
                 'created_at': check.created_at.isoformat() if check.created_at else None
             })
         return jsonify({'coach': coach, 'answers': None})
@@ -3144,7 +3176,7 @@ Pauses: Use thoughtful pauses, especially between sentences, enhancing relaxatio
         ).order_by(WeeklyCheck.created_at.desc()).limit(weeks).all()
         
         return jsonify([{
-            'answers': json.loads(c.answers),
+            'answers': c.get_answers_dict(),
             'created_at': c.created_at.isoformat() if c.created_at else None
         } for c in checks])
     
@@ -3179,7 +3211,7 @@ Pauses: Use thoughtful pauses, especially between sentences, enhancing relaxatio
             ).order_by(WeeklyCheck.created_at.desc()).first()
             
             if check:
-                answers = json.loads(check.answers)
+                answers = check.get_answers_dict()
                 inverted = {
                     'sensei': ['soreness'],
                     'sakura': ['stress', 'anxiety']
@@ -3616,7 +3648,7 @@ Rispondi SOLO con JSON, niente altro:
     @token_required
     def get_exercises_list(current_user):
         """Get available exercises for selection"""
-        profile = GymProfile.query.filter_by(user_id=current_user.id).first()
+        profile = current_user.gym_profile
         equipment = profile.get_equipment() if profile else ['barbell', 'dumbbells', 'cables', 'machines', 'bodyweight']
         
         exercises = get_exercises_for_ui(equipment)
@@ -3635,7 +3667,7 @@ Rispondi SOLO con JSON, niente altro:
     @token_required
     def get_gym_profile(current_user):
         """Get user's gym profile"""
-        profile = GymProfile.query.filter_by(user_id=current_user.id).first()
+        profile = current_user.gym_profile
         if not profile:
             return jsonify({
                 'setup_complete': False,
@@ -3672,7 +3704,7 @@ Rispondi SOLO con JSON, niente altro:
         """Save or update gym profile"""
         data = request.get_json()
         
-        profile = GymProfile.query.filter_by(user_id=current_user.id).first()
+        profile = current_user.gym_profile
         if not profile:
             profile = GymProfile(user_id=current_user.id)
             db.session.add(profile)
@@ -3688,7 +3720,7 @@ Rispondi SOLO con JSON, niente altro:
         if 'priority_muscles' in data:
             profile.set_priority_muscles(data['priority_muscles'])
         if 'equipment' in data:
-            profile.equipment = json.dumps(data['equipment'])
+            profile.equipment = data['equipment']
         if 'intensity_modifier' in data:
             profile.intensity_modifier = data['intensity_modifier']
         if 'primary_goal' in data:
@@ -3724,7 +3756,6 @@ Rispondi SOLO con JSON, niente altro:
     @token_required
     def reset_gym_data(current_user):
         """Reset all gym data for user - start fresh"""
-        import json
         try:
             # Delete exercise logs
             ExerciseLog.query.filter_by(user_id=current_user.id).delete()
@@ -3744,19 +3775,19 @@ Rispondi SOLO con JSON, niente altro:
             WorkoutProgram.query.filter_by(user_id=current_user.id).delete()
             
             # Reset profile (keep user but clear settings)
-            profile = GymProfile.query.filter_by(user_id=current_user.id).first()
+            profile = current_user.gym_profile
             if profile:
                 profile.setup_complete = False
                 profile.experience = 'beginner'
                 profile.days_per_week = 3
                 profile.session_minutes = 60
-                profile.excluded_muscles = json.dumps([])
-                profile.priority_muscles = json.dumps(['glutes', 'legs'])
-                profile.equipment = json.dumps(['barbell', 'dumbbells', 'cables', 'machines'])
+                profile.excluded_muscles = []
+                profile.priority_muscles = ['glutes', 'legs']
+                profile.equipment = ['barbell', 'dumbbells', 'cables', 'machines']
                 profile.primary_goal = 'toning'
                 profile.periodization_type = 'simple'
-                profile.favorite_exercises = json.dumps([])
-                profile.custom_exercises = json.dumps([])
+                profile.favorite_exercises = []
+                profile.custom_exercises = []
             
             db.session.commit()
             return jsonify({'success': True, 'message': '🔄 Tutti i dati resettati! Ricomincia da zero.'})
@@ -3768,7 +3799,7 @@ Rispondi SOLO con JSON, niente altro:
     @token_required
     def generate_gym_program(current_user):
         """Generate workout program using exercise database"""
-        profile = GymProfile.query.filter_by(user_id=current_user.id).first()
+        profile = current_user.gym_profile
         if not profile:
             return jsonify({'error': 'Prima configura il profilo'}), 400
         
@@ -3973,21 +4004,26 @@ Rispondi SOLO con JSON, niente altro:
 
 
             # Create workout days from database-generated program
-            for i, day_data in enumerate(program_days):
-                day = WorkoutDay(
+            # (un solo flush per tutti i giorni, poi gli esercizi in blocco)
+            days = [
+                WorkoutDay(
                     program_id=program.id,
                     day_of_week=day_data.get('day_of_week', i + 1),
                     name=day_data.get('name', f'Giorno {i+1}'),
-                    muscle_groups=json.dumps(day_data.get('muscle_groups', [])),
+                    muscle_groups=day_data.get('muscle_groups', []),
                     estimated_minutes=profile.session_minutes,
                     order=i
                 )
-                db.session.add(day)
-                db.session.flush()
-                
+                for i, day_data in enumerate(program_days)
+            ]
+            db.session.add_all(days)
+            db.session.flush()
+            
+            exercises = []
+            for day, day_data in zip(days, program_days):
                 # Create exercises
                 for j, ex_data in enumerate(day_data.get('exercises', [])):
-                    exercise = ProgramExercise(
+                    exercises.append(ProgramExercise(
                         workout_day_id=day.id,
                         order=j,
                         name=ex_data.get('name', 'Esercizio'),
@@ -4000,8 +4036,8 @@ Rispondi SOLO con JSON, niente altro:
                         rpe_target=ex_data.get('rpe_target', 7),
                         suggested_weight=ex_data.get('suggested_weight'),
                         notes=ex_data.get('notes', '')
-                    )
-                    db.session.add(exercise)
+                    ))
+            db.session.add_all(exercises)
             
             db.session.commit()
             
@@ -4029,15 +4065,27 @@ Rispondi SOLO con JSON, niente altro:
         if not program:
             return jsonify({'program': None})
         
+        # Ultimo log di ogni esercizio del programma, in una sola query
+        names = {ex.name for day in program.days for ex in day.exercises}
+        last_logs = {}
+        if names:
+            latest = db.session.query(
+                ExerciseLog.exercise_name, db.func.max(ExerciseLog.date).label('last_date')
+            ).filter(
+                ExerciseLog.user_id == current_user.id,
+                ExerciseLog.exercise_name.in_(names)
+            ).group_by(ExerciseLog.exercise_name).subquery()
+            for log in ExerciseLog.query.join(latest, db.and_(
+                ExerciseLog.exercise_name == latest.c.exercise_name,
+                ExerciseLog.date == latest.c.last_date
+            )).filter(ExerciseLog.user_id == current_user.id).order_by(ExerciseLog.id.desc()):
+                last_logs.setdefault(log.exercise_name, log)
+        
         days = []
-        for day in program.days.order_by(WorkoutDay.order):
+        for day in program.days:
             exercises = []
-            for ex in day.exercises.order_by(ProgramExercise.order):
-                # Get last logged weight for this exercise
-                last_log = ExerciseLog.query.filter_by(
-                    user_id=current_user.id,
-                    exercise_name=ex.name
-                ).order_by(ExerciseLog.date.desc()).first()
+            for ex in day.exercises:
+                last_log = last_logs.get(ex.name)
                 
                 exercises.append({
                     'id': ex.id,
@@ -4133,7 +4181,7 @@ Rispondi SOLO con JSON, niente altro:
             ).first()
             
             # Get profile for periodization
-            profile = GymProfile.query.filter_by(user_id=current_user.id).first()
+            profile = current_user.gym_profile
             periodization = getattr(profile, 'periodization_type', 'simple') if profile else 'simple'
             
             # Calculate periodization phase and weight modifier
@@ -4174,7 +4222,7 @@ Rispondi SOLO con JSON, niente altro:
                 current_day_type = 'hypertrophy'
             
             exercises = []
-            for ex in workout_day.exercises.order_by(ProgramExercise.order):
+            for ex in workout_day.exercises:
                 try:
                     last_log = ExerciseLog.query.filter_by(
                         user_id=current_user.id,
@@ -4580,7 +4628,7 @@ Rispondi SOLO con JSON, niente altro:
         # Clamp between 0.6 and 1.3
         modifier = max(0.6, min(1.3, modifier))
         
-        profile = GymProfile.query.filter_by(user_id=current_user.id).first()
+        profile = current_user.gym_profile
         if profile:
             profile.intensity_modifier = modifier
             db.session.commit()
@@ -4611,11 +4659,15 @@ Rispondi SOLO con JSON, niente altro:
         days = request.args.get('days', 30, type=int)
         start_date = date.today() - timedelta(days=days)
         
-        # Sessions
-        sessions = WorkoutSession.query.filter(
+        # Sessions (aggregati calcolati dal database)
+        total_sessions, total_volume, total_time = db.session.query(
+            db.func.count(WorkoutSession.id),
+            db.func.coalesce(db.func.sum(WorkoutSession.total_volume), 0),
+            db.func.coalesce(db.func.sum(WorkoutSession.duration_minutes), 0)
+        ).filter(
             WorkoutSession.user_id == current_user.id,
             WorkoutSession.date >= start_date
-        ).all()
+        ).one()
         
         # Exercise logs
         logs = ExerciseLog.query.filter(
@@ -4624,9 +4676,6 @@ Rispondi SOLO con JSON, niente altro:
         ).all()
         
         # Calculate stats
-        total_sessions = len(sessions)
-        total_volume = sum(s.total_volume or 0 for s in sessions)
-        total_time = sum(s.duration_minutes or 0 for s in sessions)
         prs_count = len([l for l in logs if l.is_pr])
         
         # Volume by muscle group
@@ -4688,40 +4737,46 @@ Rispondi SOLO con JSON, niente altro:
             'sessions_completed': report.sessions_completed,
             'total_volume_kg': report.total_volume_kg,
             'total_duration_min': report.total_duration_min,
-            'prs': json.loads(report.prs_achieved) if report.prs_achieved else [],
+            'prs': report.prs_achieved or [],
             'avg_rpe': report.avg_rpe,
-            'muscle_progress': json.loads(report.muscle_progress) if report.muscle_progress else {},
+            'muscle_progress': report.muscle_progress or {},
             'lou_message': report.lou_message,
             'user_choice': report.user_choice
         })
     
     def _generate_weekly_report(user, week_start, week_end):
         """Generate weekly report with Lou's analysis"""
-        # Get sessions this week
-        sessions = WorkoutSession.query.filter(
+        # Stats delle sessioni della settimana in un solo GROUP BY lato database
+        completed, total_volume, total_duration, total_rpe = db.session.query(
+            db.func.count(WorkoutSession.id),
+            db.func.coalesce(db.func.sum(WorkoutSession.total_volume), 0),
+            db.func.coalesce(db.func.sum(WorkoutSession.duration_minutes), 0),
+            db.func.coalesce(db.func.sum(WorkoutSession.overall_rpe), 0)
+        ).filter(
             WorkoutSession.user_id == user.id,
             WorkoutSession.date >= week_start,
             WorkoutSession.date <= week_end
-        ).all()
-        
-        # Get program for planned sessions
-        program = WorkoutProgram.query.filter_by(user_id=user.id, is_active=True).first()
-        planned = len(program.days.all()) if program else 0
-        
-        # Calculate stats
-        completed = len(sessions)
-        total_volume = sum(s.total_volume or 0 for s in sessions)
-        total_duration = sum(s.duration_minutes or 0 for s in sessions)
-        avg_rpe = sum(s.overall_rpe or 0 for s in sessions) / completed if completed else 0
+        ).one()
+        avg_rpe = total_rpe / completed if completed else 0
+        
+        # Programma attivo + numero di giorni pianificati (solo le colonne che servono)
+        program = db.session.query(
+            WorkoutProgram.id, WorkoutProgram.current_week, db.func.count(WorkoutDay.id)
+        ).outerjoin(WorkoutDay, WorkoutDay.program_id == WorkoutProgram.id).filter(
+            WorkoutProgram.user_id == user.id,
+            WorkoutProgram.is_active == True
+        ).group_by(WorkoutProgram.id, WorkoutProgram.current_week).first()
+        program_id, current_week, planned = program if program else (None, 1, 0)
         
         # PRs this week
-        logs = ExerciseLog.query.filter(
+        prs = [f"{name} {weight}kg" for name, weight in db.session.query(
+            ExerciseLog.exercise_name, ExerciseLog.weight_kg
+        ).filter(
             ExerciseLog.user_id == user.id,
             ExerciseLog.date >= week_start,
             ExerciseLog.date <= week_end,
             ExerciseLog.is_pr == True
-        ).all()
-        prs = [f"{l.exercise_name} {l.weight_kg}kg" for l in logs]
+        )]
         
         # Generate Lou message
         if completed == 0:
@@ -4741,15 +4796,15 @@ Rispondi SOLO con JSON, niente altro:
         
         report = GymWeeklyReport(
             user_id=user.id,
-            program_id=program.id if program else None,
-            week_number=program.current_week if program else 1,
+            program_id=program_id,
+            week_number=current_week,
             week_start=week_start,
             week_end=week_end,
             sessions_planned=planned,
             sessions_completed=completed,
             total_volume_kg=total_volume,
             total_duration_min=total_duration,
-            prs_achieved=json.dumps(prs),
+            prs_achieved=prs,
             avg_rpe=round(avg_rpe, 1),
             lou_message=lou_message
         )
@@ -4778,7 +4833,7 @@ Rispondi SOLO con JSON, niente altro:
             report.user_choice = choice
             
             # Adjust intensity based on choice
-            profile = GymProfile.query.filter_by(user_id=current_user.id).first()
+            profile = current_user.gym_profile
             if profile:
                 if choice == 'push':
                     profile.intensity_modifier = min(1.2, profile.intensity_modifier + 0.1)
@@ -4888,8 +4943,15 @@ def _metric_to_dict(m: DailyMetric) -> dict:
     }
 
 
-# Entry point
-app = create_app()
+# Entry point (gunicorn app:app). Creata al primo accesso: chi importa solo
+# create_app o i sottomoduli (es. lo scheduler) non costruisce anche l'app web
+def __getattr__(name):
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == '__main__':
+    app = create_app()
     app.run(debug=True, port=5000)# Updated Wed Dec 10 11:51:30 UTC 2025
\ No newline at end of file
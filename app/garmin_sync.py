@@ -3,19 +3,281 @@ Garmin Sync Service
 Recupera dati da Garmin Connect e li salva nel database
 """
 
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 from garminconnect import Garmin
-from app.models import db, User, DailyMetric, Activity, SyncLog
-import json
+from app.models import db, bulk_insert_rows, User, DailyMetric, DailyMetricRaw, Activity, SyncLog
+from bisect import bisect_right
+import asyncio
+import os
+import threading
+import time
 import traceback
 
 
+# Endpoint Garmin giornalieri: chiave in raw_data -> metodo del client
+DAILY_ENDPOINTS = (
+    ('summary', 'get_stats'),
+    ('sleep', 'get_sleep_data'),
+    ('hrv', 'get_hrv_data'),
+    ('spo2', 'get_spo2_data'),
+    ('fitness_age', 'get_fitnessage_data'),
+    ('max_metrics', 'get_max_metrics'),
+)
+
+# Campi DailyMetric copiati 1:1 dal daily summary Garmin (get_stats)
+_SUMMARY_MAP = (
+    ('resting_hr', 'restingHeartRate'),
+    ('min_hr', 'minHeartRate'),
+    ('max_hr', 'maxHeartRate'),
+    ('steps', 'totalSteps'),
+    ('distance_meters', 'totalDistanceMeters'),
+    ('floors_ascended', 'floorsAscended'),
+    ('moderate_intensity_minutes', 'moderateIntensityMinutes'),
+    ('vigorous_intensity_minutes', 'vigorousIntensityMinutes'),
+    ('active_seconds', 'activeSeconds'),
+    ('sedentary_seconds', 'sedentarySeconds'),
+    # Stress
+    ('stress_avg', 'averageStressLevel'),
+    ('stress_max', 'maxStressLevel'),
+    ('rest_stress_duration', 'restStressDuration'),
+    ('low_stress_duration', 'lowStressDuration'),
+    ('medium_stress_duration', 'mediumStressDuration'),
+    ('high_stress_duration', 'highStressDuration'),
+    # Body Battery
+    ('body_battery_high', 'bodyBatteryHighestValue'),
+    ('body_battery_low', 'bodyBatteryLowestValue'),
+    ('body_battery_charged', 'bodyBatteryChargedValue'),
+    ('body_battery_drained', 'bodyBatteryDrainedValue'),
+    # Respiration
+    ('avg_respiration', 'avgWakingRespirationValue'),
+    ('min_respiration', 'lowestRespirationValue'),
+    ('max_respiration', 'highestRespirationValue'),
+)
+
+# Campi DailyMetric copiati 1:1 da dailySleepDTO (get_sleep_data)
+_SLEEP_MAP = (
+    ('sleep_seconds', 'sleepTimeSeconds'),
+    ('deep_sleep_seconds', 'deepSleepSeconds'),
+    ('light_sleep_seconds', 'lightSleepSeconds'),
+    ('rem_sleep_seconds', 'remSleepSeconds'),
+    ('awake_seconds', 'awakeSleepSeconds'),
+)
+
+# Massimo numero di chiamate Garmin in parallelo (rate limit). Tenerlo entro il pool
+# della sessione garth (10 connessioni di default, con retry su 408/429/5xx)
+FETCH_CONCURRENCY = 8
+
+# Per quanto riusare un client Garmin già autenticato (secondi)
+CLIENT_TTL_SECONDS = 3600
+
+# Impatti lineari età biologica: clamp((valore - baseline) / span, -1, 1)
+RHR_BASELINE, RHR_SPAN = 60, 20     # -1 a 40bpm, 0 a 60bpm, +1 a 80bpm
+VO2_BASELINE, VO2_SPAN = 42, 13     # +1 a 29, 0 a 42, -1 a 55 (segno invertito)
+
+# Tabelle età biologica: soglie minime (>=) crescenti e impatto per fascia.
+# impatto = IMPACTS[bisect_right(THRESHOLDS, valore)]
+STEPS_THRESHOLDS = (2000, 4000, 6000, 8000, 10000, 12000)
+STEPS_IMPACTS = (1.0, 0.6, 0.3, 0.0, -0.2, -0.5, -0.8)
+HRZ_THRESHOLDS = (5, 15, 30, 45, 60)
+HRZ_IMPACTS = (0.5, 0.3, 0.0, -0.2, -0.5, -0.8)
+
+
+def _parse_garmin_ts(value):
+    """
+    Converte un timestamp Garmin in datetime (naive), None se non valido.
+    
+    Garmin usa sia stringhe ISO ('2024-12-07 07:15:00', '2024-12-07T07:15:00.0')
+    sia epoch in millisecondi (es. sleepStartTimestampLocal).
+    """
+    if not value:
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value / 1000, tz=timezone.utc).replace(tzinfo=None)
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            # Python < 3.11 non accetta frazioni di secondo tipo '.0'
+            return datetime.fromisoformat(value.partition('.')[0])
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
+def _unwrap(value):
+    """Rilancia l'eccezione salvata da asyncio.gather, altrimenti ritorna il valore"""
+    if isinstance(value, BaseException):
+        raise value
+    return value
+
+
+# Colonne DailyMetric scritte da compute_biological_age
+BIO_AGE_COLUMNS = (
+    'biological_age',
+    'bio_age_rhr_impact',
+    'bio_age_vo2_impact',
+    'bio_age_sleep_impact',
+    'bio_age_steps_impact',
+    'bio_age_hrz_impact',
+    'bio_age_stress_impact',
+)
+
+
+def compute_biological_age(real_age, resting_hr, vo2_max, sleep_seconds,
+                           steps, moderate_minutes, vigorous_minutes) -> dict:
+    """
+    Calcola l'età biologica con pesi normalizzati.
+    Se mancano metriche, i pesi vengono ridistribuiti così
+    chi ha meno dati non viene penalizzato.
+    
+    Funzione pura (solo numeri, niente ORM): usata sia dal sync
+    sia dal ricalcolo dello storico.
+    
+    Range finale: circa -8 a +8 anni rispetto all'età reale
+    
+    Returns:
+        dict {colonna DailyMetric: valore} con le chiavi di BIO_AGE_COLUMNS
+    """
+    # Ogni metrica può dare un impatto da -1 a +1 (normalizzato)
+    # Poi lo scaliamo al range finale desiderato
+    impacts = {}
+    
+    # 1. RHR Impact (baseline 60, range 40-80)
+    if resting_hr and resting_hr > 0:
+        impacts['rhr'] = max(-1, min(1, (resting_hr - RHR_BASELINE) / RHR_SPAN))
+    
+    # 2. VO2 Max Impact (baseline 42, range 30-55)
+    if vo2_max and vo2_max > 0:
+        impacts['vo2'] = max(-1, min(1, (VO2_BASELINE - vo2_max) / VO2_SPAN))
+    
+    # 3. Sleep Impact (ottimale 7-8.5h)
+    if sleep_seconds and sleep_seconds > 0:
+        sleep_hours = sleep_seconds / 3600
+        if sleep_hours >= 7 and sleep_hours <= 8.5:
+            impacts['sleep'] = -0.3  # Bonus
+        elif sleep_hours < 7:
+            # Meno sonno = peggio
+            impacts['sleep'] = min(1, (7 - sleep_hours) / 3)
+        else:
+            # Troppo sonno = leggermente peggio
+            impacts['sleep'] = min(0.5, (sleep_hours - 8.5) / 3)
+    
+    # 4. Steps Impact (target 10k)
+    if steps and steps > 0:
+        impacts['steps'] = STEPS_IMPACTS[bisect_right(STEPS_THRESHOLDS, steps)]
+    
+    # 5. Intensity Minutes Impact
+    moderate = moderate_minutes or 0
+    vigorous = vigorous_minutes or 0
+    intensity_score = moderate + (vigorous * 2)
+    
+    if intensity_score > 0 or (moderate == 0 and vigorous == 0 and steps and steps > 0):
+        # Se abbiamo dati di passi ma no intensity, consideriamo 0
+        impacts['hrz'] = HRZ_IMPACTS[bisect_right(HRZ_THRESHOLDS, intensity_score)]
+    
+    # Minimo 2 metriche per calcolare
+    if len(impacts) < 2:
+        return dict.fromkeys(BIO_AGE_COLUMNS)
+    
+    # Media degli impatti (normalizzati tra -1 e +1)
+    avg_impact = sum(impacts.values()) / len(impacts)
+    
+    # Scala al range finale: -8 a +8 anni
+    MAX_YEARS = 8
+    final_impact = avg_impact * MAX_YEARS
+    
+    # Impatti individuali scalati (per display)
+    # Mostriamo l'impatto in anni per ogni metrica
+    scale = MAX_YEARS / len(impacts)  # Distribuisci equamente
+    return {
+        'biological_age': round(real_age + final_impact, 1),
+        'bio_age_rhr_impact': round(impacts['rhr'] * scale, 1) if 'rhr' in impacts else None,
+        'bio_age_vo2_impact': round(impacts['vo2'] * scale, 1) if 'vo2' in impacts else None,
+        'bio_age_sleep_impact': round(impacts['sleep'] * scale, 1) if 'sleep' in impacts else None,
+        'bio_age_steps_impact': round(impacts['steps'] * scale, 1) if 'steps' in impacts else None,
+        'bio_age_hrz_impact': round(impacts['hrz'] * scale, 1) if 'hrz' in impacts else None,
+        'bio_age_stress_impact': None,
+    }
+
+
+def recompute_biological_age(user_id: int, real_age: int) -> int:
+    """
+    Ricalcola l'età biologica di tutto lo storico dell'utente.
+    
+    Legge solo le colonne di input (tuple, niente oggetti ORM) e riscrive
+    i risultati con un unico bulk_update_mappings. Il commit è a carico
+    del chiamante.
+    
+    Returns:
+        numero di giorni con età biologica calcolata
+    """
+    rows = db.session.query(
+        DailyMetric.id,
+        DailyMetric.resting_hr,
+        DailyMetric.vo2_max,
+        DailyMetric.sleep_seconds,
+        DailyMetric.steps,
+        DailyMetric.moderate_intensity_minutes,
+        DailyMetric.vigorous_intensity_minutes,
+    ).filter(DailyMetric.user_id == user_id).all()
+    
+    mappings = []
+    count = 0
+    for metric_id, *inputs in rows:
+        bio = compute_biological_age(real_age, *inputs)
+        bio['id'] = metric_id
+        mappings.append(bio)
+        if bio['biological_age'] is not None:
+            count += 1
+    
+    if mappings:
+        db.session.bulk_update_mappings(DailyMetric, mappings)
+    return count
+
+
 class GarminSyncService:
     
-    def __init__(self, encryption_key: str):
-        self.encryption_key = encryption_key
+    # Client autenticati condivisi tra istanze:
+    # {user_id: (client, scadenza, garmin_password_encrypted)}
+    _clients = {}
+    _clients_lock = threading.Lock()
+    
+    def __init__(self):
+        # Le risposte grezze Garmin si salvano solo per debug (GARMIN_KEEP_RAW=1)
+        self.keep_raw = os.environ.get('GARMIN_KEEP_RAW', '0') == '1'
     
-    def sync_user(self, user: User, days_back: int = 7, offset_days: int = 0) -> dict:
+    def get_client(self, user: User, force_login: bool = False) -> Garmin:
+        """Client Garmin autenticato per l'utente (riusato finché valido)"""
+        return self._get_client(user, force_login)[0]
+    
+    def _get_client(self, user: User, force_login: bool = False) -> tuple:
+        """Ritorna (client, da_cache)"""
+        if not force_login:
+            with self._clients_lock:
+                cached = self._clients.get(user.id)
+            # Se le credenziali sono cambiate il ciphertext è diverso: nuovo login
+            if cached and cached[1] > time.time() and cached[2] == user.garmin_password_encrypted:
+                return cached[0], True
+        
+        garmin_password = user.get_garmin_password()
+        if not user.garmin_email or not garmin_password:
+            raise ValueError("Credenziali Garmin non configurate")
+        
+        client = Garmin(user.garmin_email, garmin_password)
+        client.login()
+        
+        with self._clients_lock:
+            self._clients[user.id] = (
+                client, time.time() + CLIENT_TTL_SECONDS, user.garmin_password_encrypted
+            )
+        return client, False
+    
+    def drop_client(self, user_id: int):
+        """Dimentica il client in cache (il prossimo sync rifà il login)"""
+        with self._clients_lock:
+            self._clients.pop(user_id, None)
+    
+    def sync_user(self, user: User, days_back: int = 7, offset_days: int = 0,
+                  update_last_sync: bool = True, log: SyncLog = None) -> dict:
         """
         Sincronizza i dati di un utente.
         
@@ -23,12 +285,17 @@ class GarminSyncService:
             user: User da sincronizzare
             days_back: Quanti giorni sincronizzare
             offset_days: Da quale giorno partire (0 = oggi, 30 = 30 giorni fa)
+            update_last_sync: Se False, last_sync non viene toccato
+                (sync_all_users lo aggiorna in blocco alla fine)
+            log: SyncLog già creato (sync in background), altrimenti ne crea uno
         
         Returns:
             dict con risultato sync
         """
-        log = SyncLog(user_id=user.id, status='running')
-        db.session.add(log)
+        if log is None:
+            log = SyncLog(user_id=user.id)
+            db.session.add(log)
+        log.status = 'running'
         db.session.commit()
         
         result = {
@@ -38,41 +305,119 @@ class GarminSyncService:
             'errors': []
         }
         
+        now = None
         try:
-            # Login a Garmin
-            garmin_password = user.get_garmin_password(self.encryption_key)
-            if not user.garmin_email or not garmin_password:
-                raise ValueError("Credenziali Garmin non configurate")
-            
-            client = Garmin(user.garmin_email, garmin_password)
-            client.login()
+            # Login a Garmin (o client già autenticato da un sync precedente)
+            client, cached = self._get_client(user)
             
             # Sync metriche giornaliere (con offset)
-            for i in range(days_back):
-                day = date.today() - timedelta(days=i + offset_days)
-                try:
-                    synced = self._sync_daily_metrics(client, user, day)
-                    if synced:
+            today = date.today()
+            days = [today - timedelta(days=i + offset_days) for i in range(days_back)]
+            
+            # Una sola query per tutte le righe già presenti nel range
+            existing = {
+                m.date: m for m in DailyMetric.query.filter(
+                    DailyMetric.user_id == user.id,
+                    DailyMetric.date.in_(days)
+                ).all()
+            }
+            new_metrics = []
+            real_age = user.get_real_age()  # Uguale per tutti i giorni
+            
+            raw_rows = []
+            race = None
+            
+            # Fetch parallelo a finestre di FETCH_CONCURRENCY giorni: ogni finestra
+            # viene applicata prima di scaricare la successiva, così in memoria
+            # restano solo i payload di una finestra alla volta
+            for start in range(0, len(days), FETCH_CONCURRENCY):
+                window = days[start:start + FETCH_CONCURRENCY]
+                first = start == 0
+                window_race, payloads = asyncio.run(self._fetch_days(client, window, fetch_race=first))
+                
+                # Tutto fallito con un client in cache: sessione scaduta, riprova una volta
+                if first and cached and payloads and isinstance(window_race, Exception) and all(
+                    isinstance(v, Exception) for p in payloads for v in p.values()
+                ):
+                    client = self.get_client(user, force_login=True)
+                    window_race, payloads = asyncio.run(self._fetch_days(client, window, fetch_race=True))
+                if first:
+                    race = window_race
+                
+                for day, payload in zip(window, payloads):
+                    metric = existing.get(day) or DailyMetric(user_id=user.id, date=day)
+                    try:
+                        raw_data = self._sync_daily_metrics(metric, real_age, payload, race)
                         result['metrics_synced'] += 1
-                except Exception as e:
-                    result['errors'].append(f"Metrics {day}: {str(e)}")
+                        if day not in existing:
+                            new_metrics.append(metric)
+                        if self.keep_raw:
+                            raw_rows.append({
+                                'user_id': user.id,
+                                'date': day,
+                                'raw_json_gz': DailyMetricRaw.compress(raw_data),
+                            })
+                    except Exception as e:
+                        result['errors'].append(f"Metrics {day}: {str(e)}")
+            
+            # Le righe esistenti vengono aggiornate dal flush, le nuove in blocco
+            # (solo le colonne mappate e valorizzate: i default restano quelli della colonna)
+            metric_columns = [c.key for c in DailyMetric.__table__.columns]
+            bulk_insert_rows(DailyMetric, [
+                {key: loaded[key] for key in metric_columns if key in loaded}
+                for loaded in (db.inspect(m).dict for m in new_metrics)
+            ], conflict_columns=('user_id', 'date'))
+            
+            # Raw JSON in tabella separata: sostituisce quelli dei giorni sincronizzati
+            if raw_rows:
+                DailyMetricRaw.query.filter(
+                    DailyMetricRaw.user_id == user.id,
+                    DailyMetricRaw.date.in_([r['date'] for r in raw_rows])
+                ).delete(synchronize_session=False)
+                db.session.bulk_insert_mappings(DailyMetricRaw, raw_rows)
             
             # Sync attività recenti (solo se offset=0)
             if offset_days == 0:
                 try:
-                    activities = client.get_activities(0, 20)  # Ultime 20
+                    # Solo le attività dall'ultima salvata (1 giorno di margine per upload in ritardo):
+                    # non da last_sync, che avanza anche se il fetch attività fallisce
+                    last_start = db.session.query(db.func.max(Activity.start_time)).filter(
+                        Activity.user_id == user.id
+                    ).scalar()
+                    if last_start:
+                        since = last_start.date() - timedelta(days=1)
+                    else:
+                        since = today - timedelta(days=days_back)
+                    activities = client.get_activities_by_date(since.isoformat(), today.isoformat())
+                    
+                    # Una sola query per sapere quali attività abbiamo già
+                    ids = [a['activityId'] for a in activities if a.get('activityId')]
+                    existing_ids = set(
+                        garmin_id for (garmin_id,) in db.session.query(Activity.garmin_activity_id)
+                        .filter(Activity.garmin_activity_id.in_(ids))
+                    ) if ids else set()
+                    
+                    activity_rows = []
                     for act in activities:
                         try:
-                            synced = self._sync_activity(user, act)
-                            if synced:
-                                result['activities_synced'] += 1
+                            row = self._sync_activity(user, act, existing_ids)
+                            if row:
+                                activity_rows.append(row)
                         except Exception as e:
                             result['errors'].append(f"Activity {act.get('activityId')}: {str(e)}")
+                    if activity_rows:
+                        # Savepoint: se l'insert fallisce (transazione abortita su Postgres)
+                        # si perdono solo le attività, non le metriche già scritte
+                        with db.session.begin_nested():
+                            bulk_insert_rows(Activity, activity_rows, conflict_columns=('garmin_activity_id',))
+                        result['activities_synced'] = len(activity_rows)
                 except Exception as e:
                     result['errors'].append(f"Activities fetch: {str(e)}")
             
             # Update user last sync
-            user.last_sync = datetime.utcnow()
+            now = datetime.utcnow()
+            if update_last_sync:
+                user.last_sync = now
             
             # Update log
             log.status = 'success' if not result['errors'] else 'partial'
@@ -84,98 +429,94 @@ class GarminSyncService:
             result['success'] = True
             
         except Exception as e:
+            self.drop_client(user.id)
+            # Una query fallita abortisce la transazione: senza rollback il commit del log non passa
+            db.session.rollback()
             log.status = 'error'
             log.error_message = f"{str(e)}\n{traceback.format_exc()}"
             result['errors'].append(str(e))
         
         finally:
-            log.finished_at = datetime.utcnow()
+            log.finished_at = now or datetime.utcnow()
             db.session.commit()
         
         return result
     
-    def _sync_daily_metrics(self, client: Garmin, user: User, day: date) -> bool:
-        """Sincronizza le metriche di un giorno specifico"""
+    async def _fetch_days(self, client: Garmin, days: list, fetch_race: bool = True) -> tuple:
+        """
+        Scarica da Garmin i dati dei giorni indicati in parallelo.
         
-        day_str = day.isoformat()
+        Il client garminconnect è bloccante: ogni chiamata gira in un thread
+        (asyncio.to_thread) e un semaforo limita le richieste contemporanee.
+        Le eccezioni non vengono propagate ma ritornate al posto del valore.
         
-        # Controlla se esiste già
-        existing = DailyMetric.query.filter_by(user_id=user.id, date=day).first()
-        if existing:
-            metric = existing
-        else:
-            metric = DailyMetric(user_id=user.id, date=day)
+        Returns:
+            (race_predictions o None se fetch_race=False,
+             [ {endpoint: dati o eccezione} per ogni giorno ])
+        """
+        sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+        
+        async def call(method, *args):
+            async with sem:
+                return await asyncio.to_thread(getattr(client, method), *args)
+        
+        async def fetch_day(day):
+            day_str = day.isoformat()
+            values = await asyncio.gather(
+                *[call(method, day_str) for _, method in DAILY_ENDPOINTS],
+                return_exceptions=True
+            )
+            return dict(zip((key for key, _ in DAILY_ENDPOINTS), values))
+        
+        calls = [fetch_day(day) for day in days]
+        if not fetch_race:
+            return None, await asyncio.gather(*calls)
+        # Le race predictions non dipendono dal giorno: una sola chiamata
+        race, *payloads = await asyncio.gather(
+            call('get_race_predictions'),
+            *calls,
+            return_exceptions=True
+        )
+        return race, payloads
+    
+    def _sync_daily_metrics(self, metric: DailyMetric, real_age: int, payload: dict, race) -> dict:
+        """
+        Aggiorna la metrica di un giorno con i dati già scaricati da Garmin.
+        Ritorna le risposte grezze (raw_data) per il salvataggio di debug.
+        """
         
-        # Fetch dati da Garmin
+        # Dati da Garmin
         raw_data = {}
         
         # Daily summary
         try:
-            summary = client.get_stats(day_str)
+            summary = _unwrap(payload['summary'])
             raw_data['summary'] = summary
             
-            metric.resting_hr = summary.get('restingHeartRate')
-            metric.min_hr = summary.get('minHeartRate')
-            metric.max_hr = summary.get('maxHeartRate')
-            metric.steps = summary.get('totalSteps')
+            for attr, key in _SUMMARY_MAP:
+                setattr(metric, attr, summary.get(key))
             metric.total_calories = int(summary.get('totalKilocalories') or 0)
             metric.active_calories = int(summary.get('activeKilocalories') or 0)
-            metric.distance_meters = summary.get('totalDistanceMeters')
-            metric.floors_ascended = summary.get('floorsAscended')
-            metric.moderate_intensity_minutes = summary.get('moderateIntensityMinutes')
-            metric.vigorous_intensity_minutes = summary.get('vigorousIntensityMinutes')
-            metric.active_seconds = summary.get('activeSeconds')
-            metric.sedentary_seconds = summary.get('sedentarySeconds')
-            
-            # Stress
-            metric.stress_avg = summary.get('averageStressLevel')
-            metric.stress_max = summary.get('maxStressLevel')
-            metric.rest_stress_duration = summary.get('restStressDuration')
-            metric.low_stress_duration = summary.get('lowStressDuration')
-            metric.medium_stress_duration = summary.get('mediumStressDuration')
-            metric.high_stress_duration = summary.get('highStressDuration')
-            
-            # Body Battery
-            metric.body_battery_high = summary.get('bodyBatteryHighestValue')
-            metric.body_battery_low = summary.get('bodyBatteryLowestValue')
-            metric.body_battery_charged = summary.get('bodyBatteryChargedValue')
-            metric.body_battery_drained = summary.get('bodyBatteryDrainedValue')
-            
-            # Respiration
-            metric.avg_respiration = summary.get('avgWakingRespirationValue')
-            metric.min_respiration = summary.get('lowestRespirationValue')
-            metric.max_respiration = summary.get('highestRespirationValue')
             
         except Exception as e:
             raw_data['summary_error'] = str(e)
         
         # Sleep data
         try:
-            sleep = client.get_sleep_data(day_str)
+            sleep = _unwrap(payload['sleep'])
             raw_data['sleep'] = sleep
             
             daily_sleep = sleep.get('dailySleepDTO', {})
-            metric.sleep_seconds = daily_sleep.get('sleepTimeSeconds')
-            metric.deep_sleep_seconds = daily_sleep.get('deepSleepSeconds')
-            metric.light_sleep_seconds = daily_sleep.get('lightSleepSeconds')
-            metric.rem_sleep_seconds = daily_sleep.get('remSleepSeconds')
-            metric.awake_seconds = daily_sleep.get('awakeSleepSeconds')
+            for attr, key in _SLEEP_MAP:
+                setattr(metric, attr, daily_sleep.get(key))
             
             # Sleep times
-            if daily_sleep.get('sleepStartTimestampLocal'):
-                try:
-                    metric.sleep_start = datetime.fromisoformat(
-                        daily_sleep['sleepStartTimestampLocal'].replace('.0', '')
-                    )
-                except:
-                    pass
-            if daily_sleep.get('sleepEndTimestampLocal'):
-                try:
-                    metric.sleep_end = datetime.fromisoformat(
-                        daily_sleep['sleepEndTimestampLocal'].replace('.0', '')
-                    )
-                except:
-                    pass
+            sleep_start = _parse_garmin_ts(daily_sleep.get('sleepStartTimestampLocal'))
+            if sleep_start:
+                metric.sleep_start = sleep_start
+            sleep_end = _parse_garmin_ts(daily_sleep.get('sleepEndTimestampLocal'))
+            if sleep_end:
+                metric.sleep_end = sleep_end
                     
             # Sleep score (se disponibile)
             sleep_scores = daily_sleep.get('sleepScores', {})
@@ -187,7 +528,7 @@ class GarminSyncService:
         
         # HRV (se disponibile)
         try:
-            hrv = client.get_hrv_data(day_str)
+            hrv = _unwrap(payload['hrv'])
             raw_data['hrv'] = hrv
             
             if hrv:
@@ -199,7 +540,7 @@ class GarminSyncService:
         
         # SpO2
         try:
-            spo2 = client.get_spo2_data(day_str)
+            spo2 = _unwrap(payload['spo2'])
             raw_data['spo2'] = spo2
             
             if spo2:
@@ -210,7 +551,7 @@ class GarminSyncService:
         
         # Fitness Age
         try:
-            fitness = client.get_fitnessage_data(day_str)
+            fitness = _unwrap(payload['fitness_age'])
             raw_data['fitness_age'] = fitness
             
             if fitness:
@@ -225,7 +566,7 @@ class GarminSyncService:
         
         # VO2 Max
         try:
-            max_metrics = client.get_max_metrics(day_str)
+            max_metrics = _unwrap(payload['max_metrics'])
             raw_data['max_metrics'] = max_metrics
             
             if max_metrics and isinstance(max_metrics, list) and len(max_metrics) > 0:
@@ -248,7 +589,7 @@ class GarminSyncService:
         
         # Race Predictions
         try:
-            race = client.get_race_predictions()
+            race = _unwrap(race)
             raw_data['race_predictions'] = race
             
             if race:
@@ -260,29 +601,26 @@ class GarminSyncService:
             raw_data['race_predictions_error'] = str(e)
         
         # Calcola metriche derivate
-        self._calculate_scores(metric, user)
-        
-        # Salva raw JSON
-        metric.raw_json = json.dumps(raw_data, default=str)
+        self._calculate_scores(metric, real_age)
         
-        if not existing:
-            db.session.add(metric)
-        
-        return True
+        return raw_data
     
-    def _sync_activity(self, user: User, activity_data: dict) -> bool:
-        """Sincronizza una singola attività"""
+    def _sync_activity(self, user: User, activity_data: dict, existing_ids: set) -> dict:
+        """
+        Prepara la riga di una singola attività per l'insert in blocco.
+        Ritorna None se l'attività non ha id o è già sincronizzata.
+        """
         
         garmin_id = activity_data.get('activityId')
         if not garmin_id:
-            return False
+            return None
         
         # Controlla se esiste già
-        existing = Activity.query.filter_by(garmin_activity_id=garmin_id).first()
-        if existing:
-            return False  # Già sincronizzata
+        if garmin_id in existing_ids:
+            return None  # Già sincronizzata
+        existing_ids.add(garmin_id)
         
-        activity = Activity(
+        activity = dict(
             user_id=user.id,
             garmin_activity_id=garmin_id,
             activity_name=activity_data.get('activityName'),
@@ -303,28 +641,16 @@ class GarminSyncService:
             vigorous_intensity_minutes=activity_data.get('vigorousIntensityMinutes'),
         )
         
-        # Parse start time
-        start_str = activity_data.get('startTimeLocal')
-        if start_str:
-            try:
-                activity.start_time = datetime.strptime(start_str, '%Y-%m-%d %H:%M:%S')
-            except:
-                pass
-        
-        end_str = activity_data.get('endTimeGMT')
-        if end_str:
-            try:
-                activity.end_time = datetime.strptime(end_str, '%Y-%m-%d %H:%M:%S')
-            except:
-                pass
+        # Parse start/end time ('YYYY-MM-DD HH:MM:SS')
+        activity['start_time'] = _parse_garmin_ts(activity_data.get('startTimeLocal'))
+        activity['end_time'] = _parse_garmin_ts(activity_data.get('endTimeGMT'))
         
         # Calcola strain dell'attività
-        activity.strain_score = self._calculate_activity_strain(activity_data)
+        activity['strain_score'] = self._calculate_activity_strain(activity_data)
         
-        db.session.add(activity)
-        return True
+        return activity
     
-    def _calculate_scores(self, metric: DailyMetric, user: User):
+    def _calculate_scores(self, metric: DailyMetric, real_age: int):
         """Calcola Recovery, Strain, Sleep Performance e Biological Age"""
         
         # --- RECOVERY SCORE (0-100) ---
@@ -414,116 +740,21 @@ class GarminSyncService:
             metric.sleep_performance = int((duration_pct * 0.6) + (quality_pct * 0.4))
         
         # --- BIOLOGICAL AGE ---
-        self._calculate_biological_age(metric, user)
+        self._calculate_biological_age(metric, real_age)
     
-    def _calculate_biological_age(self, metric: DailyMetric, user: User):
-        """
-        Calcola l'età biologica con pesi normalizzati.
-        Se mancano metriche, i pesi vengono ridistribuiti così
-        chi ha meno dati non viene penalizzato.
-        
-        Range finale: circa -8 a +8 anni rispetto all'età reale
-        """
-        real_age = user.get_real_age()
-        
-        # Ogni metrica può dare un impatto da -1 a +1 (normalizzato)
-        # Poi lo scaliamo al range finale desiderato
-        impacts = {}
-        
-        # 1. RHR Impact (baseline 60, range 40-80)
-        if metric.resting_hr and metric.resting_hr > 0:
-            rhr = metric.resting_hr
-            # -1 a 40bpm, 0 a 60bpm, +1 a 80bpm
-            raw = (rhr - 60) / 20
-            impacts['rhr'] = max(-1, min(1, raw))
-        
-        # 2. VO2 Max Impact (baseline 42, range 30-55)
-        if metric.vo2_max and metric.vo2_max > 0:
-            vo2 = metric.vo2_max
-            # +1 a 30, 0 a 42, -1 a 55
-            raw = (42 - vo2) / 13
-            impacts['vo2'] = max(-1, min(1, raw))
-        
-        # 3. Sleep Impact (ottimale 7-8.5h)
-        if metric.sleep_seconds and metric.sleep_seconds > 0:
-            sleep_hours = metric.sleep_seconds / 3600
-            if sleep_hours >= 7 and sleep_hours <= 8.5:
-                impacts['sleep'] = -0.3  # Bonus
-            elif sleep_hours < 7:
-                # Meno sonno = peggio
-                impacts['sleep'] = min(1, (7 - sleep_hours) / 3)
-            else:
-                # Troppo sonno = leggermente peggio
-                impacts['sleep'] = min(0.5, (sleep_hours - 8.5) / 3)
-        
-        # 4. Steps Impact (target 10k)
-        if metric.steps and metric.steps > 0:
-            steps = metric.steps
-            if steps >= 12000:
-                impacts['steps'] = -0.8
-            elif steps >= 10000:
-                impacts['steps'] = -0.5
-            elif steps >= 8000:
-                impacts['steps'] = -0.2
-            elif steps >= 6000:
-                impacts['steps'] = 0.0
-            elif steps >= 4000:
-                impacts['steps'] = 0.3
-            elif steps >= 2000:
-                impacts['steps'] = 0.6
-            else:
-                impacts['steps'] = 1.0
-        
-        # 5. Intensity Minutes Impact
-        moderate = metric.moderate_intensity_minutes or 0
-        vigorous = metric.vigorous_intensity_minutes or 0
-        intensity_score = moderate + (vigorous * 2)
-        
-        if intensity_score > 0 or (moderate == 0 and vigorous == 0 and metric.steps and metric.steps > 0):
-            # Se abbiamo dati di passi ma no intensity, consideriamo 0
-            if intensity_score >= 60:
-                impacts['hrz'] = -0.8
-            elif intensity_score >= 45:
-                impacts['hrz'] = -0.5
-            elif intensity_score >= 30:
-                impacts['hrz'] = -0.2
-            elif intensity_score >= 15:
-                impacts['hrz'] = 0.0
-            elif intensity_score >= 5:
-                impacts['hrz'] = 0.3
-            else:
-                impacts['hrz'] = 0.5
-        
-        # Minimo 2 metriche per calcolare
-        if len(impacts) < 2:
-            metric.biological_age = None
-            metric.bio_age_rhr_impact = None
-            metric.bio_age_vo2_impact = None
-            metric.bio_age_sleep_impact = None
-            metric.bio_age_steps_impact = None
-            metric.bio_age_hrz_impact = None
-            metric.bio_age_stress_impact = None
-            return
-        
-        # Media degli impatti (normalizzati tra -1 e +1)
-        avg_impact = sum(impacts.values()) / len(impacts)
-        
-        # Scala al range finale: -8 a +8 anni
-        MAX_YEARS = 8
-        final_impact = avg_impact * MAX_YEARS
-        
-        # Salva gli impatti individuali scalati (per display)
-        # Mostriamo l'impatto in anni per ogni metrica
-        scale = MAX_YEARS / len(impacts)  # Distribuisci equamente
-        metric.bio_age_rhr_impact = round(impacts.get('rhr', 0) * scale, 1) if 'rhr' in impacts else None
-        metric.bio_age_vo2_impact = round(impacts.get('vo2', 0) * scale, 1) if 'vo2' in impacts else None
-        metric.bio_age_sleep_impact = round(impacts.get('sleep', 0) * scale, 1) if 'sleep' in impacts else None
-        metric.bio_age_steps_impact = round(impacts.get('steps', 0) * scale, 1) if 'steps' in impacts else None
-        metric.bio_age_hrz_impact = round(impacts.get('hrz', 0) * scale, 1) if 'hrz' in impacts else None
-        metric.bio_age_stress_impact = None
-        
-        # Età biologica finale
-        metric.biological_age = round(real_age + final_impact, 1)
+    def _calculate_biological_age(self, metric: DailyMetric, real_age: int):
+        """Calcola l'età biologica della metrica (vedi compute_biological_age)"""
+        bio = compute_biological_age(
+            real_age,
+            metric.resting_hr,
+            metric.vo2_max,
+            metric.sleep_seconds,
+            metric.steps,
+            metric.moderate_intensity_minutes,
+            metric.vigorous_intensity_minutes,
+        )
+        for column, value in bio.items():
+            setattr(metric, column, value)
     
     def _calculate_activity_strain(self, activity: dict) -> float:
         """Calcola lo strain di una singola attività"""
@@ -549,16 +780,26 @@ class GarminSyncService:
         return min(21.0, round(strain, 1))
 
 
-def sync_all_users(app, encryption_key: str):
+def sync_all_users(app):
     """Funzione per il cron job che sincronizza tutti gli utenti"""
     with app.app_context():
-        service = GarminSyncService(encryption_key)
-        users = User.query.filter_by(sync_enabled=True).all()
+        service = GarminSyncService()
+        # Solo le colonne usate dal sync, senza il join eager su gym_profile
+        users = User.query.filter_by(sync_enabled=True).options(
+            db.load_only(
+                User.email, User.garmin_email, User.garmin_password_encrypted,
+                User.birth_year, User.last_sync,
+            ),
+            db.lazyload('*'),
+        ).all()
         
         results = []
+        last_sync_updates = []
         for user in users:
             try:
-                result = service.sync_user(user)
+                result = service.sync_user(user, update_last_sync=False)
+                if result['success']:
+                    last_sync_updates.append({'id': user.id, 'last_sync': datetime.utcnow()})
                 results.append({
                     'user_id': user.id,
                     'email': user.email,
@@ -572,4 +813,9 @@ def sync_all_users(app, encryption_key: str):
                     'error': str(e)
                 })
         
+        # Un solo UPDATE batch per last_sync invece di uno per utente
+        if last_sync_updates:
+            db.session.bulk_update_mappings(User, last_sync_updates)
+            db.session.commit()
+        
         return results
\ No newline at end of file
@@ -1,16 +1,163 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-from cryptography.fernet import Fernet
+from sqlalchemy.dialects.postgresql import JSONB, insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.hybrid import hybrid_property
+from datetime import date, datetime
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from functools import lru_cache
+from types import MappingProxyType
 import base64
+import csv
+import gzip
 import hashlib
+import io
+import orjson
 
 db = SQLAlchemy()
 
-def get_fernet(key: str) -> Fernet:
-    """Crea un oggetto Fernet da una chiave stringa"""
-    key_bytes = hashlib.sha256(key.encode()).digest()
-    key_b64 = base64.urlsafe_b64encode(key_bytes)
-    return Fernet(key_b64)
+# JSON nativo: JSONB su Postgres, JSON (testo) su SQLite. Il driver restituisce già list/dict
+JSONType = db.JSON().with_variant(JSONB(), 'postgresql')
+
+# Età usata quando l'utente non ha indicato l'anno di nascita
+DEFAULT_AGE = 42
+
+# Sotto questa soglia COPY non conviene (tabella temporanea + round-trip extra)
+COPY_MIN_ROWS = 200
+
+# Derivazione chiave Fernet: PBKDF2 (costoso, si paga una volta per processo grazie alla cache)
+FERNET_KDF_SALT = b'garmin-whoop-fernet'
+FERNET_KDF_ITERATIONS = 200_000
+
+
+@lru_cache(maxsize=8)
+def get_fernet(key: str) -> MultiFernet:
+    """
+    Crea il cifrario da una chiave stringa (cache per chiave).
+    
+    Cifra con la chiave PBKDF2; decifra anche i token creati con la vecchia
+    derivazione SHA-256 semplice, così le password già salvate restano leggibili.
+    """
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(), length=32,
+        salt=FERNET_KDF_SALT, iterations=FERNET_KDF_ITERATIONS,
+    )
+    current = Fernet(base64.urlsafe_b64encode(kdf.derive(key.encode())))
+    legacy = Fernet(base64.urlsafe_b64encode(hashlib.sha256(key.encode()).digest()))
+    return MultiFernet([current, legacy])
+
+
+def _column_value(column, row: dict):
+    """Valore di una colonna per una riga, applicando il default Python se manca"""
+    if column.key in row:
+        return row[column.key]
+    if column.default is not None:
+        return column.default.arg(None) if callable(column.default.arg) else column.default.arg
+    return None
+
+
+def bulk_insert_rows(model, rows: list, conflict_columns: tuple = ()):
+    """
+    Inserisce molte righe (dict colonna -> valore) in una volta.
+    
+    Su PostgreSQL/psycopg2, da COPY_MIN_ROWS righe in su, carica i dati con
+    COPY in una tabella temporanea e li travasa con un solo INSERT ... SELECT
+    (ON CONFLICT DO UPDATE su conflict_columns). Sotto soglia usa un INSERT
+    multi-riga (insertmanyvalues, pagine da 1000) con lo stesso upsert, così
+    due sync concorrenti non falliscono sul vincolo unico. Il commit è a
+    carico del chiamante.
+    """
+    if not rows:
+        return
+    
+    dialect = db.session.get_bind().dialect
+    table = model.__table__
+    provided = {c for c in table.columns if any(c.key in row for row in rows)}
+    # Le colonne con solo default lato server vanno omesse se nessuna riga le valorizza
+    columns = [
+        c for c in table.columns
+        if not c.primary_key and (c.server_default is None or c.default is not None or c in provided)
+    ]
+    
+    # In caso di conflitto si aggiornano le colonne valorizzate, non i timestamp di default
+    # (created_at resta quello originale); ON CONFLICT DO UPDATE non applica gli onupdate
+    # (updated_at): vanno messi nel SET
+    updated = [
+        c for c in columns
+        if c.name not in conflict_columns and (c in provided or c.server_default is None)
+    ]
+    touched = [
+        c for c in table.columns
+        if c not in provided and c.onupdate is not None and c.onupdate.is_clause_element
+    ]
+    
+    if len(rows) < COPY_MIN_ROWS or dialect.driver != 'psycopg2':
+        if not conflict_columns or dialect.name not in ('postgresql', 'sqlite'):
+            db.session.bulk_insert_mappings(model, rows)
+            return
+        insert = postgresql_insert if dialect.name == 'postgresql' else sqlite_insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(conflict_columns),
+            set_={
+                **{c.name: stmt.excluded[c.name] for c in updated},
+                **{c.name: c.onupdate.arg for c in touched},
+            },
+        )
+        # executemany vuole le stesse chiavi in ogni riga
+        db.session.execute(stmt, [{c.key: _column_value(c, row) for c in columns} for row in rows])
+        return
+    
+    buf = _copy_csv(columns, rows)
+    names = ', '.join(f'"{c.name}"' for c in columns)
+    tmp = f'_copy_{table.name}'
+    sql = f'INSERT INTO {table.name} ({names}) SELECT {names} FROM {tmp}'
+    if conflict_columns:
+        updates = ', '.join(
+            [f'"{c.name}" = EXCLUDED."{c.name}"' for c in updated]
+            + [f'"{c.name}" = {c.onupdate.arg.compile(dialect=dialect)}' for c in touched]
+        )
+        sql += f" ON CONFLICT ({', '.join(conflict_columns)}) DO UPDATE SET {updates}"
+    
+    with db.session.connection().connection.cursor() as cursor:
+        cursor.execute(f'CREATE TEMP TABLE {tmp} ON COMMIT DROP AS SELECT {names} FROM {table.name} WITH NO DATA')
+        cursor.copy_expert(f"COPY {tmp} ({names}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf)
+        cursor.execute(sql)
+        cursor.execute(f'DROP TABLE {tmp}')
+
+
+def _copy_value(column, value):
+    """
+    Valore nel formato testo che COPY accetta per il tipo della colonna.
+    
+    A differenza di un INSERT, COPY non fa cast impliciti: Garmin manda float
+    (es. floorsAscended 7.31, averageHR 137.0) anche per colonne INTEGER.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(column.type, db.Boolean):
+        return 't' if value else 'f'
+    if isinstance(column.type, db.Integer):
+        return int(round(value))
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return '\\x' + value.hex()
+    if isinstance(value, (dict, list)):
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+    return value
+
+
+def _copy_csv(columns: list, rows: list) -> io.StringIO:
+    """CSV per COPY FROM STDIN; COPY non conosce i default Python: applicali qui"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([_copy_value(c, _column_value(c, row)) for c in columns])
+    buf.seek(0)
+    return buf
 
 
 class User(db.Model):
@@ -40,29 +187,47 @@ class User(db.Model):
     fat_goal = db.Column(db.Integer, default=70)       # grammi
     
     # Timestamps
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now(), onupdate=db.func.now())
+    
+    # Indici parziali: il sync giornaliero legge solo gli utenti attivi
+    __table_args__ = (
+        db.Index('ix_users_sync_enabled', 'id',
+                 postgresql_where=db.text('sync_enabled = true'), sqlite_where=db.text('sync_enabled = true')),
+    )
     
     # Relazioni
     daily_metrics = db.relationship('DailyMetric', backref='user', lazy='dynamic')
     activities = db.relationship('Activity', backref='user', lazy='dynamic')
     
-    def set_garmin_password(self, password: str, encryption_key: str):
-        """Cripta e salva la password Garmin"""
-        f = get_fernet(encryption_key)
+    def set_garmin_password(self, password: str):
+        """Cripta e salva la password Garmin (Fernet creato una volta in create_app)"""
+        f = current_app.extensions['fernet']
         self.garmin_password_encrypted = f.encrypt(password.encode()).decode()
     
-    def get_garmin_password(self, encryption_key: str) -> str:
+    def get_garmin_password(self) -> str:
         """Decripta e ritorna la password Garmin"""
         if not self.garmin_password_encrypted:
             return None
-        f = get_fernet(encryption_key)
+        f = current_app.extensions['fernet']
         return f.decrypt(self.garmin_password_encrypted.encode()).decode()
     
-    def get_real_age(self):
+    @hybrid_property
+    def real_age(self):
         if self.birth_year:
-            return datetime.now().year - self.birth_year
-        return 42
+            return date.today().year - self.birth_year
+        return DEFAULT_AGE
+    
+    @real_age.expression
+    def real_age(cls):
+        # Stesso calcolo lato SQL, per filtrare/ordinare per età nelle query
+        return db.func.coalesce(
+            db.cast(db.extract('year', db.func.current_date()), db.Integer) - cls.birth_year,
+            DEFAULT_AGE,
+        )
+    
+    def get_real_age(self):
+        return self.real_age
 
 
 class DailyMetric(db.Model):
@@ -152,18 +317,44 @@ class DailyMetric(db.Model):
     bio_age_stress_impact = db.Column(db.Float)
     bio_age_hrz_impact = db.Column(db.Float)
     
-    # Raw data per debug
-    raw_json = db.Column(db.Text)
+    # Raw data per debug (legacy: i nuovi sync scrivono in DailyMetricRaw)
+    # deferred: caricato solo se letto esplicitamente
+    raw_json = db.deferred(db.Column(db.Text))
     
     # Timestamps
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now(), onupdate=db.func.now())
     
     __table_args__ = (
         db.UniqueConstraint('user_id', 'date', name='unique_user_date'),
+        # Lookup (user_id, date) -> id senza leggere la riga (index-only scan su Postgres)
+        db.Index('ix_user_date_cover', 'user_id', 'date', postgresql_include=['id']),
     )
 
 
+class DailyMetricRaw(db.Model):
+    """Risposte Garmin grezze di un giorno (JSON compresso gzip), solo per debug"""
+    __tablename__ = 'daily_metric_raw'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    raw_json_gz = db.deferred(db.Column(db.LargeBinary, nullable=False))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'date', name='unique_user_date_raw'),
+    )
+    
+    @staticmethod
+    def compress(raw_data: dict) -> bytes:
+        # orjson serializza direttamente in bytes e gestisce date/datetime nativamente
+        return gzip.compress(orjson.dumps(raw_data, default=str, option=orjson.OPT_NON_STR_KEYS))
+    
+    def get_raw_data(self) -> dict:
+        return orjson.loads(gzip.decompress(self.raw_json_gz)) if self.raw_json_gz else {}
+
+
 class Activity(db.Model):
     __tablename__ = 'activities'
     
@@ -203,7 +394,11 @@ class Activity(db.Model):
     strain_score = db.Column(db.Float)
     
     # Timestamps
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.Index('ix_activities_user_start', 'user_id', db.text('start_time DESC')),
+    )
 
 
 class SyncLog(db.Model):
@@ -212,7 +407,7 @@ class SyncLog(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
     finished_at = db.Column(db.DateTime)
     status = db.Column(db.String(50))  # success, error, partial
     error_message = db.Column(db.Text)
@@ -226,10 +421,14 @@ class ChatMessage(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    role = db.Column(db.String(20), nullable=False)  # user, assistant
+    role = db.Column(db.Enum('user', 'assistant', name='chat_role'), nullable=False)
     content = db.Column(db.Text, nullable=False)
     coach = db.Column(db.String(20))  # sensei, sakura
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.Index('ix_chat_messages_user_coach_created', 'user_id', 'coach', db.text('created_at DESC')),
+    )
 
 
 class UserMemory(db.Model):
@@ -242,7 +441,12 @@ class UserMemory(db.Model):
     content = db.Column(db.Text, nullable=False)
     coach = db.Column(db.String(20))
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.Index('ix_user_memories_user_active', 'user_id',
+                 postgresql_where=db.text('is_active = true'), sqlite_where=db.text('is_active = true')),
+    )
 
 
 
@@ -262,7 +466,7 @@ class FatigueLog(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     date = db.Column(db.Date, nullable=False)
     value = db.Column(db.Integer, nullable=False)  # 1-10
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
     
     # Unique constraint: un solo valore per utente/giorno
     __table_args__ = (db.UniqueConstraint('user_id', 'date', name='unique_user_date_fatigue'),)
@@ -277,20 +481,18 @@ class WeeklyCheck(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     coach = db.Column(db.String(20), nullable=False)  # 'sensei' o 'sakura'
-    answers = db.Column(db.Text, nullable=False)  # JSON string
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    answers = db.Column(JSONType, nullable=False)  # dict
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
     
     user = db.relationship('User', backref=db.backref('weekly_checks', lazy='dynamic'))
     
     def get_answers_dict(self):
         """Ritorna answers come dict"""
-        import json
-        return json.loads(self.answers) if self.answers else {}
+        return self.answers or {}
     
     def set_answers_dict(self, answers_dict):
         """Salva answers da dict"""
-        import json
-        self.answers = json.dumps(answers_dict)
+        self.answers = answers_dict
 
 
 class FoodEntry(db.Model):
@@ -325,13 +527,71 @@ class FoodEntry(db.Model):
     source = db.Column(db.String(50))  # openfoodfacts, manual, ai_estimate
     
     # Timestamps
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.Index('ix_food_entries_user_date_meal', 'user_id', 'date', 'meal_type'),
+    )
     
     user = db.relationship('User', backref=db.backref('food_entries', lazy='dynamic'))
 
 
 # ==================== LOU - SCULPTING COACH ====================
 
+# Fasi del ciclo per GymProfile.get_cycle_phase (senza 'day', aggiunto per utente).
+# Read-only: i chiamanti ricevono sempre una copia
+_CYCLE_PHASES = {
+    # Mestruazione
+    'mestruation': MappingProxyType({
+        'phase': 'mestruation',
+        'phase_name': '🔴 Mestruazione',
+        'intensity_modifier': 0.8,
+        'recommendation': 'Ascolta il corpo. Se ti senti bene vai, altrimenti sessione leggera o riposo.',
+        'focus': 'Mobilità, cardio leggero, o riposo attivo',
+        'avoid': 'Nulla di forzato se hai crampi'
+    }),
+    # Fase follicolare
+    'follicular': MappingProxyType({
+        'phase': 'follicular',
+        'phase_name': '🟢 Fase Follicolare',
+        'intensity_modifier': 1.1,
+        'recommendation': 'SPACCA! Estrogeni alti = più forza e recupero. Ideale per PR!',
+        'focus': 'Sessioni intense, carichi pesanti, volume alto',
+        'avoid': 'Niente - è il momento di spingere!'
+    }),
+    # Ovulazione
+    'ovulation': MappingProxyType({
+        'phase': 'ovulation',
+        'phase_name': '🟡 Ovulazione',
+        'intensity_modifier': 1.0,
+        'recommendation': 'Forza al top ma legamenti più lassi. Attenzione alla tecnica!',
+        'focus': 'Forza con controllo, evita movimenti esplosivi/balistici',
+        'avoid': 'Jump squat, box jump, movimenti esplosivi'
+    }),
+    # Fase luteale
+    'luteal': MappingProxyType({
+        'phase': 'luteal',
+        'phase_name': '🟠 Fase Luteale',
+        'intensity_modifier': 0.9,
+        'recommendation': 'Progesterone alto = più fatica. Riduci un po\' e focus qualità.',
+        'focus': 'Volume moderato, tecnica perfetta, steady state cardio',
+        'avoid': 'Sessioni troppo lunghe o intense'
+    }),
+    # PMS / Pre-mestruale
+    'pms': MappingProxyType({
+        'phase': 'pms',
+        'phase_name': '🟣 Pre-mestruale',
+        'intensity_modifier': 0.75,
+        'recommendation': 'Sii gentile con te stessa. Movimento leggero, no pressione.',
+        'focus': 'Yoga, stretching, camminate, sessioni brevi',
+        'avoid': 'Aspettative alte, sessioni lunghe'
+    }),
+}
+
+# Ultimo giorno (incluso) delle fasi a durata fissa
+_CYCLE_PHASE_BOUNDS = ((5, 'mestruation'), (14, 'follicular'), (17, 'ovulation'))
+
+
 class GymProfile(db.Model):
     """Profilo palestra utente per Lou"""
     __tablename__ = 'gym_profiles'
@@ -347,13 +607,13 @@ class GymProfile(db.Model):
     session_minutes = db.Column(db.Integer, default=60)  # 45, 60, 90
     
     # Muscoli da escludere (JSON array: ["abs", "shoulders"])
-    excluded_muscles = db.Column(db.Text, default='[]')
+    excluded_muscles = db.Column(JSONType, default=list)
     
     # Muscoli prioritari (JSON array: ["glutes", "legs"])
-    priority_muscles = db.Column(db.Text, default='["glutes", "legs"]')
+    priority_muscles = db.Column(JSONType, default=lambda: ['glutes', 'legs'])
     
     # Equipaggiamento disponibile (JSON array)
-    equipment = db.Column(db.Text, default='["barbell", "dumbbells", "cables", "machines"]')
+    equipment = db.Column(JSONType, default=lambda: ['barbell', 'dumbbells', 'cables', 'machines'])
     
     # Modificatore intensità globale (0.6 = relax, 1.0 = normale, 1.2 = beast)
     intensity_modifier = db.Column(db.Float, default=1.0)
@@ -371,38 +631,28 @@ class GymProfile(db.Model):
     periodization_type = db.Column(db.String(20), default='simple')  # simple, dup, undulating
     
     # === ESERCIZI PREFERITI ===
-    favorite_exercises = db.Column(db.Text, default='[]')  # JSON array di exercise IDs
-    custom_exercises = db.Column(db.Text, default='[]')  # JSON array di {id, name, muscle}
+    favorite_exercises = db.Column(JSONType, default=list)  # array di exercise IDs
+    custom_exercises = db.Column(JSONType, default=list)  # array di {id, name, muscle}
     
     def get_favorite_exercises(self):
-        import json
-        try:
-            return json.loads(self.favorite_exercises or '[]')
-        except:
-            return []
+        return self.favorite_exercises or []
     
     def set_favorite_exercises(self, exercises):
-        import json
-        self.favorite_exercises = json.dumps(exercises or [])
+        self.favorite_exercises = exercises or []
     
     def get_custom_exercises(self):
-        import json
-        try:
-            return json.loads(self.custom_exercises or '[]')
-        except:
-            return []
+        return self.custom_exercises or []
     
     def set_custom_exercises(self, exercises):
-        import json
-        self.custom_exercises = json.dumps(exercises or [])
+        self.custom_exercises = exercises or []
     
     # Setup completato?
     setup_complete = db.Column(db.Boolean, default=False)
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now(), onupdate=db.func.now())
     
-    user = db.relationship('User', backref=db.backref('gym_profile', uselist=False))
+    user = db.relationship('User', backref=db.backref('gym_profile', uselist=False, lazy='joined'))
     
     def get_cycle_phase(self):
         """
@@ -423,89 +673,34 @@ class GymProfile(db.Model):
         
         Returns: dict con phase, day, recommendations
         """
-        from datetime import date, timedelta
-        
         if not self.track_cycle or not self.last_period_start:
             return None
         
         days_since = (date.today() - self.last_period_start).days
         cycle_day = (days_since % self.cycle_length) + 1
         
-        if cycle_day <= 5:
-            # Mestruazione
-            return {
-                'phase': 'mestruation',
-                'phase_name': '🔴 Mestruazione',
-                'day': cycle_day,
-                'intensity_modifier': 0.8,
-                'recommendation': 'Ascolta il corpo. Se ti senti bene vai, altrimenti sessione leggera o riposo.',
-                'focus': 'Mobilità, cardio leggero, o riposo attivo',
-                'avoid': 'Nulla di forzato se hai crampi'
-            }
-        elif cycle_day <= 14:
-            # Fase follicolare
-            return {
-                'phase': 'follicular',
-                'phase_name': '🟢 Fase Follicolare',
-                'day': cycle_day,
-                'intensity_modifier': 1.1,
-                'recommendation': 'SPACCA! Estrogeni alti = più forza e recupero. Ideale per PR!',
-                'focus': 'Sessioni intense, carichi pesanti, volume alto',
-                'avoid': 'Niente - è il momento di spingere!'
-            }
-        elif cycle_day <= 17:
-            # Ovulazione
-            return {
-                'phase': 'ovulation',
-                'phase_name': '🟡 Ovulazione',
-                'day': cycle_day,
-                'intensity_modifier': 1.0,
-                'recommendation': 'Forza al top ma legamenti più lassi. Attenzione alla tecnica!',
-                'focus': 'Forza con controllo, evita movimenti esplosivi/balistici',
-                'avoid': 'Jump squat, box jump, movimenti esplosivi'
-            }
-        elif cycle_day <= self.cycle_length - 5:
-            # Fase luteale
-            return {
-                'phase': 'luteal',
-                'phase_name': '🟠 Fase Luteale',
-                'day': cycle_day,
-                'intensity_modifier': 0.9,
-                'recommendation': 'Progesterone alto = più fatica. Riduci un po\' e focus qualità.',
-                'focus': 'Volume moderato, tecnica perfetta, steady state cardio',
-                'avoid': 'Sessioni troppo lunghe o intense'
-            }
+        for bound, phase in _CYCLE_PHASE_BOUNDS:
+            if cycle_day <= bound:
+                break
         else:
-            # PMS / Pre-mestruale
-            return {
-                'phase': 'pms',
-                'phase_name': '🟣 Pre-mestruale',
-                'day': cycle_day,
-                'intensity_modifier': 0.75,
-                'recommendation': 'Sii gentile con te stessa. Movimento leggero, no pressione.',
-                'focus': 'Yoga, stretching, camminate, sessioni brevi',
-                'avoid': 'Aspettative alte, sessioni lunghe'
-            }
+            # La fine della fase luteale dipende dalla lunghezza del ciclo
+            phase = 'luteal' if cycle_day <= self.cycle_length - 5 else 'pms'
+        return {**_CYCLE_PHASES[phase], 'day': cycle_day}
     
     def get_excluded_muscles(self):
-        import json
-        return json.loads(self.excluded_muscles) if self.excluded_muscles else []
+        return self.excluded_muscles or []
     
     def set_excluded_muscles(self, muscles):
-        import json
-        self.excluded_muscles = json.dumps(muscles)
+        self.excluded_muscles = muscles
     
     def get_priority_muscles(self):
-        import json
-        return json.loads(self.priority_muscles) if self.priority_muscles else []
+        return self.priority_muscles or []
     
     def set_priority_muscles(self, muscles):
-        import json
-        self.priority_muscles = json.dumps(muscles)
+        self.priority_muscles = muscles
     
     def get_equipment(self):
-        import json
-        return json.loads(self.equipment) if self.equipment else []
+        return self.equipment or []
 
 
 class WorkoutProgram(db.Model):
@@ -532,10 +727,17 @@ class WorkoutProgram(db.Model):
     # Timestamps
     started_at = db.Column(db.DateTime)
     completed_at = db.Column(db.DateTime)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.Index('ix_workout_programs_user_active', 'user_id',
+                 postgresql_where=db.text('is_active = true'), sqlite_where=db.text('is_active = true')),
+    )
     
     user = db.relationship('User', backref=db.backref('workout_programs', lazy='dynamic'))
-    days = db.relationship('WorkoutDay', backref='program', lazy='dynamic', cascade='all, delete-orphan')
+    # Programma -> giorni -> esercizi si leggono sempre insieme: selectin, già ordinati
+    days = db.relationship('WorkoutDay', backref='program', lazy='selectin',
+                           order_by='WorkoutDay.order', cascade='all, delete-orphan')
 
 
 class WorkoutDay(db.Model):
@@ -552,7 +754,7 @@ class WorkoutDay(db.Model):
     name = db.Column(db.String(100), nullable=False)  # "Leg Day 🦵"
     
     # Muscoli target (JSON array)
-    muscle_groups = db.Column(db.Text)  # ["glutes", "quads", "hamstrings"]
+    muscle_groups = db.Column(JSONType)  # ["glutes", "quads", "hamstrings"]
     
     # Durata stimata in minuti
     estimated_minutes = db.Column(db.Integer, default=60)
@@ -560,11 +762,11 @@ class WorkoutDay(db.Model):
     # Ordine nel programma
     order = db.Column(db.Integer, default=0)
     
-    exercises = db.relationship('ProgramExercise', backref='workout_day', lazy='dynamic', cascade='all, delete-orphan')
+    exercises = db.relationship('ProgramExercise', backref='workout_day', lazy='selectin',
+                                order_by='ProgramExercise.order', cascade='all, delete-orphan')
     
     def get_muscle_groups(self):
-        import json
-        return json.loads(self.muscle_groups) if self.muscle_groups else []
+        return self.muscle_groups or []
 
 
 class ProgramExercise(db.Model):
@@ -621,7 +823,7 @@ class ExerciseLog(db.Model):
     
     # Risultati
     sets_completed = db.Column(db.Integer)
-    reps_per_set = db.Column(db.Text)  # JSON array: [12, 12, 10, 8]
+    reps_per_set = db.Column(JSONType)  # [12, 12, 10, 8]
     weight_kg = db.Column(db.Float)
     
     # Feedback
@@ -635,19 +837,23 @@ class ExerciseLog(db.Model):
     is_pr = db.Column(db.Boolean, default=False)
     
     # Note
-    notes = db.Column(db.Text)
+    notes = db.deferred(db.Column(db.Text))
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.Index('ix_exercise_logs_user_date', 'user_id', db.text('date DESC')),
+        db.Index('ix_exercise_logs_user_pr', 'user_id', db.text('date DESC'),
+                 postgresql_where=db.text('is_pr = true'), sqlite_where=db.text('is_pr = true')),
+    )
     
     user = db.relationship('User', backref=db.backref('exercise_logs', lazy='dynamic'))
     
     def get_reps_array(self):
-        import json
-        return json.loads(self.reps_per_set) if self.reps_per_set else []
+        return self.reps_per_set or []
     
     def set_reps_array(self, reps):
-        import json
-        self.reps_per_set = json.dumps(reps)
+        self.reps_per_set = reps
 
 
 class WorkoutSession(db.Model):
@@ -671,13 +877,18 @@ class WorkoutSession(db.Model):
     feeling = db.Column(db.String(20))  # great, good, okay, tired, exhausted
     
     # Note
-    notes = db.Column(db.Text)
-    lou_comment = db.Column(db.Text)  # Commento generato da Lou
+    # Testi lunghi, mai letti nelle liste: caricati solo su richiesta
+    notes = db.deferred(db.Column(db.Text), group='text')
+    lou_comment = db.deferred(db.Column(db.Text), group='text')  # Commento generato da Lou
     
     # PRs in questa sessione (JSON array)
     prs_achieved = db.Column(db.Text)  # ["Hip Thrust 65kg", "Squat 50kg"]
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.Index('ix_workout_sessions_user_date', 'user_id', db.text('date DESC')),
+    )
     
     user = db.relationship('User', backref=db.backref('workout_sessions', lazy='dynamic'))
 
@@ -702,13 +913,13 @@ class GymWeeklyReport(db.Model):
     total_duration_min = db.Column(db.Integer)
     
     # PRs della settimana
-    prs_achieved = db.Column(db.Text)  # JSON array
+    prs_achieved = db.Column(JSONType)  # array
     
     # Medie
     avg_rpe = db.Column(db.Float)
     
     # Progressi per muscolo (JSON)
-    muscle_progress = db.Column(db.Text)  # {"glutes": +5%, "legs": +3%}
+    muscle_progress = db.Column(JSONType)  # {"glutes": +5%, "legs": +3%}
     
     # Messaggio di Lou
     lou_message = db.Column(db.Text)
@@ -716,6 +927,10 @@ class GymWeeklyReport(db.Model):
     # Scelta utente per prossima settimana
     user_choice = db.Column(db.String(20))  # push, maintain, deload
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.Index('ix_gym_weekly_reports_user_week', 'user_id', db.text('week_start DESC')),
+    )
     
     user = db.relationship('User', backref=db.backref('gym_weekly_reports', lazy='dynamic'))
\ No newline at end of file
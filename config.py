@@ -1,5 +1,7 @@
 import os
 
+import orjson
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
     ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', 'dev-encryption-key-32chars!')
@@ -9,4 +11,20 @@ class Config:
     
     # Fix per Railway PostgreSQL
     if SQLALCHEMY_DATABASE_URI and SQLALCHEMY_DATABASE_URI.startswith('postgres://'):
-        SQLALCHEMY_DATABASE_URI = SQLALCHEMY_DATABASE_URI.replace('postgres://', 'postgresql://', 1)
\ No newline at end of file
+        SQLALCHEMY_DATABASE_URI = SQLALCHEMY_DATABASE_URI.replace('postgres://', 'postgresql://', 1)
+    
+    # INSERT/UPDATE multipli in un solo statement (insertmanyvalues / execute_batch psycopg2)
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'insertmanyvalues_page_size': 1000,
+        # Colonne JSON/JSONB (answers, preferenze palestra, ...) con orjson invece di json
+        'json_serializer': lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode(),
+        'json_deserializer': orjson.loads,
+    }
+    if SQLALCHEMY_DATABASE_URI.split('://')[0] in ('postgresql', 'postgresql+psycopg2'):
+        SQLALCHEMY_ENGINE_OPTIONS['executemany_mode'] = 'values_plus_batch'
+    if SQLALCHEMY_DATABASE_URI.startswith('postgresql'):
+        # Pool per web worker + sync: connessioni riusate, verificate prima dell'uso
+        # e riciclate prima che il Postgres gestito le chiuda
+        SQLALCHEMY_ENGINE_OPTIONS.update(pool_size=10, max_overflow=20, pool_pre_ping=True, pool_recycle=1800)
+        # now() dei server_default in UTC, come il resto dell'app (datetime.utcnow)
+        SQLALCHEMY_ENGINE_OPTIONS['connect_args'] = {'options': '-c timezone=utc'}
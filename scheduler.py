@@ -5,6 +5,7 @@ Può essere eseguito come servizio separato o integrato nell'app
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from sqlalchemy.pool import NullPool
 from app import create_app
 from app.garmin_sync import sync_all_users
 from config import Config
@@ -14,11 +15,24 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def run_sync():
-    """Esegue sync di tutti gli utenti"""
+class SchedulerConfig(Config):
+    """
+    Il processo scheduler lavora due volte al giorno: niente pool, ogni job
+    apre le sue connessioni e le chiude a fine sync
+    """
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        **{k: v for k, v in Config.SQLALCHEMY_ENGINE_OPTIONS.items()
+           if k not in ('pool_size', 'max_overflow', 'pool_recycle')},
+        'poolclass': NullPool,
+    }
+
+
+def run_sync(app=None):
+    """Esegue sync di tutti gli utenti (crea l'app solo se non viene passata)"""
     logger.info("Starting scheduled sync...")
-    app = create_app()
-    results = sync_all_users(app, Config.ENCRYPTION_KEY)
+    if app is None:
+        app = create_app(SchedulerConfig)
+    results = sync_all_users(app)
     logger.info(f"Sync completed: {results}")
     return results
 
@@ -26,11 +40,14 @@ def run_sync():
 def start_scheduler():
     """Avvia lo scheduler"""
     scheduler = BackgroundScheduler()
+    # App (ed engine) creati una volta sola e riusati a ogni esecuzione del job
+    app = create_app(SchedulerConfig)
     
     # Sync ogni giorno alle 6:00 e alle 12:00
     scheduler.add_job(
         run_sync,
         CronTrigger(hour='6,12', minute='0'),
+        args=[app],
         id='garmin_sync',
         name='Garmin Data Sync'
     )
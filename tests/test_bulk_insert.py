@@ -0,0 +1,48 @@
+from datetime import date, datetime
+from types import SimpleNamespace
+
+from app.garmin_sync import GarminSyncService
+from app.models import Activity, DailyMetric, _copy_csv
+
+
+def _copy_lines(model, rows):
+    columns = [c for c in model.__table__.columns if not c.primary_key and c.server_default is None]
+    lines = _copy_csv(columns, rows).getvalue().splitlines()
+    return [dict(zip((c.key for c in columns), line.split(','))) for line in lines]
+
+
+def test_copy_rounds_float_daily_metrics_for_integer_columns():
+    (row,) = _copy_lines(DailyMetric, [{
+        'user_id': 1,
+        'date': date(2024, 12, 7),
+        'floors_ascended': 7.31,
+        'fitness_age': 38.0,
+        'distance_meters': 5123.4,
+        'hrv_last_night': None,
+    }])
+    
+    assert row['floors_ascended'] == '7'
+    assert row['fitness_age'] == '38'
+    assert row['date'] == '2024-12-07'
+    assert row['hrv_last_night'] == '\\N'
+
+
+def test_copy_rounds_float_activity_payload():
+    activity = GarminSyncService()._sync_activity(SimpleNamespace(id=1), {
+        'activityId': 123456789,
+        'activityName': 'Corsa',
+        'activityType': {'typeKey': 'running'},
+        'duration': 3600.5,
+        'calories': 612.0,
+        'averageHR': 137.0,
+        'maxHR': 171.6,
+        'startTimeLocal': '2024-12-07 07:15:00',
+    }, set())
+    
+    (row,) = _copy_lines(Activity, [activity])
+    
+    assert row['calories'] == '612'
+    assert row['avg_hr'] == '137'
+    assert row['max_hr'] == '172'
+    assert row['duration_seconds'] == '3600.5'
+    assert row['start_time'] == datetime(2024, 12, 7, 7, 15).isoformat()